@@ -0,0 +1,52 @@
+class AdaptiveController:
+	"""受信レポート（損失率・RTT・ジッター）から映像の段階（ladder の何段目か）を決める。
+
+	ladder は品質の高い順の [幅, 高さ, fps] の並び（None は通常の設定を表す）。混雑の兆候（損失率・RTT・
+	ジッターのいずれかが high 以上）が down_after 回続いたら 1 段下げ、
+	すべてが low 未満の良好な状態が up_after 回続いたら 1 段上げる。
+	上げる条件を厳しくして、段階が行ったり来たりしないようにする。
+	"""
+
+	def __init__(self, ladder, down_after=2, up_after=5,
+			loss_high=0.05, loss_low=0.01, rtt_high=0.3, rtt_low=0.15,
+			jitter_high=0.05, jitter_low=0.02):
+		self.ladder = [tuple(rung) if rung is not None else None for rung in ladder]
+		self.down_after = down_after
+		self.up_after = up_after
+		self.loss_high = loss_high
+		self.loss_low = loss_low
+		self.rtt_high = rtt_high
+		self.rtt_low = rtt_low
+		self.jitter_high = jitter_high
+		self.jitter_low = jitter_low
+		self.level = 0
+		self._congested = 0
+		self._good = 0
+
+	@property
+	def rung(self):
+		"""現在の段階の (幅, 高さ, fps)"""
+		return self.ladder[self.level]
+
+	def update(self, loss, rtt=None, jitter=None):
+		"""1 回分の受信レポートを反映し、段階が変わったら True を返す。
+
+		loss は損失率（0〜1）、rtt・jitter は秒（不明なら None）。
+		"""
+		rtt = rtt or 0.0
+		jitter = jitter or 0.0
+		congested = loss >= self.loss_high or rtt >= self.rtt_high or jitter >= self.jitter_high
+		good = loss < self.loss_low and rtt < self.rtt_low and jitter < self.jitter_low
+		self._congested = self._congested + 1 if congested else 0
+		self._good = self._good + 1 if good else 0
+		if self._congested >= self.down_after and self.level < len(self.ladder) - 1:
+			self.level += 1
+			self._congested = 0
+			self._good = 0
+			return True
+		if self._good >= self.up_after and self.level > 0:
+			self.level -= 1
+			self._congested = 0
+			self._good = 0
+			return True
+		return False
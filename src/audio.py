@@ -0,0 +1,320 @@
+import asyncio
+import threading
+import numpy as np
+
+
+class AudioRingBuffer:
+	"""固定容量の音声リングバッファ（int16, 形状 (samples, channels)）。
+
+	sounddevice のコールバックスレッドから write() し、各ピアは reader() で
+	作った AudioReader（自分専用の読み出し位置）から読む。バッファは最初に
+	確保したものを使い回す。
+	"""
+
+	def __init__(self, capacity, channels):
+		self.capacity = capacity
+		self.channels = channels
+		self._buf = np.zeros((capacity, channels), np.int16)
+		self._lock = threading.Lock()
+		# 書き込み位置（通算サンプル数）
+		self._write_pos = 0
+
+	def write(self, data):
+		"""(samples, channels) の int16 データを書き込む（コールバックスレッドから呼ぶ）"""
+		n = len(data)
+		if n > self.capacity:
+			data = data[-self.capacity:]
+			n = self.capacity
+		with self._lock:
+			start = self._write_pos % self.capacity
+			first = min(n, self.capacity - start)
+			self._buf[start:start + first] = data[:first]
+			if first < n:
+				self._buf[:n - first] = data[first:]
+			self._write_pos += n
+
+	def reader(self, target, max_skip_ratio=0.02):
+		"""現在の書き込み位置から読み始める AudioReader を作る"""
+		return AudioReader(self, target, max_skip_ratio)
+
+
+class AudioReader:
+	"""AudioRingBuffer を読む 1 ピア分のカーソル。
+
+	遅延が伸び続けないよう、溜まった量（depth）を target サンプル付近に保つ:
+	- 容量を超えて遅れたら（未読分が上書きされたら）、target まで進める（overrun）
+	- target を超えていれば、1 ブロックあたり max_skip_ratio の割合までずつ
+	  古いサンプルを読み飛ばし、少しずつ追いつく（drift 補正）
+	"""
+
+	def __init__(self, ring, target, max_skip_ratio=0.02):
+		self.ring = ring
+		self.target = min(target, ring.capacity)
+		self.max_skip_ratio = max_skip_ratio
+		self._read_pos = ring._write_pos
+		self.underruns = 0
+		self.overruns = 0
+		self.dropped = 0
+
+	@property
+	def depth(self):
+		"""読み出し待ちのサンプル数"""
+		return self.ring._write_pos - self._read_pos
+
+	def read(self, out):
+		"""out (samples, channels) を埋められれば True、データ不足なら False を返す"""
+		ring = self.ring
+		n = len(out)
+		with ring._lock:
+			depth = ring._write_pos - self._read_pos
+			if depth > ring.capacity:
+				# 読み出しが追いつかず上書きされた。古い音声を捨てて目標遅延まで戻す
+				drop = depth - self.target
+				self._read_pos += drop
+				self.dropped += drop
+				self.overruns += 1
+				depth = self.target
+			if depth < n:
+				return False
+			# 目標より溜まっていれば少しずつ読み飛ばす
+			excess = depth - n - self.target
+			if excess > 0:
+				skip = min(excess, max(int(n * self.max_skip_ratio), 1))
+				self._read_pos += skip
+				self.dropped += skip
+			start = self._read_pos % ring.capacity
+			first = min(n, ring.capacity - start)
+			out[:first] = ring._buf[start:start + first]
+			if first < n:
+				out[first:] = ring._buf[:n - first]
+			self._read_pos += n
+		return True
+
+	def stats(self):
+		return {
+			"depth": self.depth,
+			"underruns": self.underruns,
+			"overruns": self.overruns,
+			"dropped": self.dropped,
+		}
+
+
+class SilenceGate:
+	"""ブロックごとの RMS / ピークで有音・無音を判定するゲート（ヒステリシス付き）。
+
+	ピークが open_db 以上のブロックが来たら即座に有音へ戻る。ピークが open_db
+	未満かつ RMS が close_db 未満のブロックが hang_blocks 続いたら無音とみなす。
+	レベルは dBFS。
+	"""
+
+	def __init__(self, open_db=-60.0, close_db=-66.0, hang_blocks=15):
+		self.open_level = 32768.0 * 10 ** (open_db / 20)
+		self.close_level = 32768.0 * 10 ** (close_db / 20)
+		self.hang_blocks = hang_blocks
+		self.active = True
+		self._quiet_blocks = 0
+
+	def update(self, block):
+		"""block (int16) を判定し、有音なら True を返す"""
+		# int16 の -32768 を abs するとあふれるため、最大・最小から求める
+		peak = max(int(block.max()), -int(block.min()))
+		if peak >= self.open_level:
+			self.active = True
+			self._quiet_blocks = 0
+			return True
+		samples = block.astype(np.float32)
+		rms = float(np.sqrt(np.dot(samples.ravel(), samples.ravel()) / samples.size))
+		if rms < self.close_level:
+			self._quiet_blocks += 1
+			if self._quiet_blocks >= self.hang_blocks:
+				self.active = False
+		else:
+			self._quiet_blocks = 0
+		return self.active
+
+
+def sounddevice_stream(samplerate, channels, blocksize, callback, device=None):
+	"""sounddevice の入力ストリームを作る（AudioCapture の既定の stream_factory）"""
+	# PortAudio の無い環境（合成音源でのベンチマークなど）でも audio を import できるよう、ここで読み込む
+	import sounddevice as sd
+	if device is not None:
+		return sd.InputStream(
+			device=device,
+			samplerate=samplerate,
+			channels=channels,
+			dtype='int16',
+			callback=callback,
+			blocksize=blocksize
+		)
+	return sd.InputStream(
+		samplerate=samplerate,
+		channels=channels,
+		dtype='int16',
+		callback=callback,
+		blocksize=blocksize
+	)
+
+
+class AudioCapture:
+	"""デバイス単位で共有する音声キャプチャ。
+
+	入力ストリームを 1 つだけ開いて AudioRingBuffer に書き込み、各ピアの
+	SystemAudioTrack は自分の AudioReader で読む。最初の購読で開始し、
+	最後の購読解除で停止するため、2 台目以降の接続・切断ではデバイスを開き直さない。
+	stream_factory は sounddevice_stream と同じ引数でストリーム（start/stop/close を
+	持ち、ブロックごとに callback を呼ぶもの）を作る関数。省略時は sounddevice を使う。
+	linger を指定すると、最後の購読解除から linger 秒はストリームを閉じずに待つ
+	（再接続のたびにデバイスを開き直さない）。
+	"""
+
+	def __init__(self, samplerate, channels, device_id=None, max_latency_ms=200, stream_factory=None, linger=0):
+		self.samplerate = samplerate
+		self.channels = channels
+		self.device_id = device_id
+		self.stream_factory = stream_factory or sounddevice_stream
+		self.blocksize = int(samplerate * 0.02)
+		self.buffer = AudioRingBuffer(
+			capacity=max(int(samplerate * max_latency_ms / 1000), self.blocksize * 2),
+			channels=channels
+		)
+		self.stream = None
+		self._subscribers = 0
+		self.linger = linger
+		self._linger_handle = None
+		self._waiting = 0
+		self._loop = None
+		self._data_ready = None
+
+	@property
+	def subscribers(self):
+		return self._subscribers
+
+	def subscribe(self):
+		self._subscribers += 1
+		if self._linger_handle is not None:
+			self._linger_handle.cancel()
+			self._linger_handle = None
+		if self.stream is None:
+			self._start()
+
+	def unsubscribe(self):
+		if self._subscribers == 0:
+			return
+		self._subscribers -= 1
+		if self._subscribers == 0:
+			if self.linger > 0 and self._loop is not None:
+				# 再接続に備えて linger 秒は止めずに待つ
+				self._linger_handle = self._loop.call_later(self.linger, self._stop_lingering)
+			else:
+				self._stop()
+
+	def _stop_lingering(self):
+		self._linger_handle = None
+		if self._subscribers == 0:
+			self._stop()
+
+	def close(self):
+		"""購読者が残っていてもすぐに止め、以後は保持しない（作り直したキャプチャと同時にデバイスを開かない）"""
+		self.linger = 0
+		if self._linger_handle is not None:
+			self._linger_handle.cancel()
+			self._linger_handle = None
+		self._stop()
+
+	def _start(self):
+		print("Starting audio recording...")
+		self._loop = asyncio.get_event_loop()
+		self._data_ready = asyncio.Event()
+		try:
+			self.stream = self.stream_factory(
+				self.samplerate, self.channels, self.blocksize, self._audio_callback, device=self.device_id
+			)
+			self.stream.start()
+			print(f"Audio stream started (device={self.device_id})")
+		except Exception as e:
+			self.stream = None
+			print(f"Error starting audio stream: {e}")
+
+	def _stop(self):
+		if self.stream is None:
+			return
+		print("Stopping audio recording...")
+		self.stream.stop()
+		self.stream.close()
+		self.stream = None
+		# 待っている読み手（別のキャプチャへ切り替えたトラック）を起こす
+		if self._waiting:
+			self._notify()
+
+	def _audio_callback(self, indata, frames, time, status):
+		if status:
+			print(status)
+		# リングバッファへ直接書き込み、待っている読み手があれば起こす
+		self.buffer.write(indata)
+		if self._waiting:
+			self._loop.call_soon_threadsafe(self._notify)
+
+	def _notify(self):
+		ready = self._data_ready
+		self._data_ready = asyncio.Event()
+		ready.set()
+
+	async def read(self, reader, out):
+		"""reader で out を埋める。データが足りなければ次のブロックを待つ。
+
+		埋めたら True を返す。ストリームが開いていない・待っている間に止まった場合は
+		埋めずに False を返す（out の中身は前のまま）。
+		"""
+		if reader.read(out):
+			return True
+		if self.stream is None:
+			return False
+		started = self._loop.time()
+		self._waiting += 1
+		try:
+			while True:
+				ready = self._data_ready
+				if reader.read(out):
+					break
+				if self.stream is None:
+					return False
+				await ready.wait()
+		finally:
+			self._waiting -= 1
+		# 通常は次のブロックを待つだけ。1.5 ブロック分以上途切れたら取りこぼしとして数える
+		if self._loop.time() - started > 1.5 * self.blocksize / self.samplerate:
+			reader.underruns += 1
+		return True
+
+
+# (デバイス, サンプルレート, チャンネル数) ごとの共有キャプチャ
+_captures = {}
+
+
+def get_audio_capture(samplerate, channels, device_id=None, max_latency_ms=200, stream_factory=None, linger=0):
+	"""設定に対応する共有 AudioCapture を返す（無ければ作成）"""
+	key = (device_id, samplerate, channels)
+	capture = _captures.get(key)
+	if capture is None:
+		capture = AudioCapture(
+			samplerate, channels,
+			device_id=device_id,
+			max_latency_ms=max_latency_ms,
+			stream_factory=stream_factory,
+			linger=linger
+		)
+		_captures[key] = capture
+	return capture
+
+
+def audio_captures():
+	"""作成済みの共有 AudioCapture の一覧"""
+	return list(_captures.values())
+
+
+def discard_audio_capture(samplerate, channels, device_id=None):
+	"""設定に対応する共有キャプチャを一覧から外してすぐに止める（次の get_audio_capture で作り直す）"""
+	capture = _captures.pop((device_id, samplerate, channels), None)
+	if capture is not None:
+		capture.close()
+	return capture
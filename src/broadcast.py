@@ -0,0 +1,239 @@
+import asyncio
+import multiprocessing
+import time
+import av
+from aiortc import MediaStreamTrack
+from aiortc.codecs.vpx import number_of_threads
+from aiortc.mediastreams import MediaStreamError
+from metrics import histogram
+
+
+_ENCODE_SECONDS = histogram("video_broadcast_encode_seconds", "Shared VP8 encode time in broadcast mode")
+
+# エンコードがエラーで止まったとき、視聴者が残っていれば作り直すまでの秒数
+RESTART_DELAY = 1.0
+
+
+def open_vp8_encoder(width, height, bitrate):
+	"""aiortc の Vp8Encoder と同じリアルタイム向け設定の libvpx エンコーダーを開く"""
+	codec = av.CodecContext.create("libvpx", "w")
+	codec.width = width
+	codec.height = height
+	codec.bit_rate = bitrate
+	codec.pix_fmt = "yuv420p"
+	# キーフレームは新しい視聴者・受信側の要求・場面転換のときだけ入れる
+	codec.gop_size = 3000
+	codec.qmin = 2
+	codec.qmax = 56
+	codec.options = {
+		"bufsize": str(bitrate),
+		"cpu-used": "-6",
+		"deadline": "realtime",
+		"lag-in-frames": "0",
+		"minrate": str(bitrate),
+		"maxrate": str(bitrate),
+		"noise-sensitivity": "4",
+		"overshoot-pct": "15",
+		"partitions": "0",
+		"static-thresh": "1",
+		"undershoot-pct": "100",
+	}
+	codec.thread_count = number_of_threads(width * height, multiprocessing.cpu_count())
+	return codec
+
+
+class VideoBroadcaster:
+	"""1 つの映像ソースを 1 回だけエンコードし、全視聴者（BroadcastTrack）へ配る。
+
+	source_factory は VideoFrame を返す recv() を持つトラック（ScreenTrack）を作る関数。
+	最初の視聴者で開始し、最後の視聴者が抜けたら止める。エンコード済みのパケットを
+	受け取った RTCRtpSender は再エンコードせずにパケット化だけを行うため、視聴者が
+	増えてもエンコードの負荷は変わらない。ビットレートは全視聴者で共通（bitrate）。
+	"""
+
+	def __init__(self, source_factory, bitrate=1500000, queue_size=30):
+		self.source_factory = source_factory
+		self.bitrate = bitrate
+		self.queue_size = queue_size
+		self.source = None
+		# ソースの共有キャプチャ（ソースを作り直す間も最後のものを残す）
+		self.capture = None
+		self._viewers = set()
+		self._task = None
+		self._codec = None
+		self._force_keyframe = False
+
+	@property
+	def running(self):
+		# エンコードのタスクがエラーで終わっていても、ソースを止めるまでは動作中として扱う
+		return self.source is not None
+
+	@property
+	def viewers(self):
+		return len(self._viewers)
+
+	def subscribe(self, viewer):
+		self._viewers.add(viewer)
+		if not self.running:
+			self._start()
+		# 新しい視聴者はキーフレームから始める（静止中でもすぐ次のフレームを作らせる）
+		self.request_keyframe()
+
+	def unsubscribe(self, viewer):
+		self._viewers.discard(viewer)
+		if not self._viewers and self.running:
+			self._stop()
+
+	def request_keyframe(self):
+		"""次にエンコードするフレームをキーフレームにする（どの視聴者の要求もここに集まる）"""
+		self._force_keyframe = True
+		if self.source is not None:
+			self.source.capture.poke()
+
+	def switch_capture(self, capture):
+		"""映像ソースの共有キャプチャを capture に切り替え、視聴者の解像度の要求も移す"""
+		if self.source is None:
+			return
+		previous = self.source.capture
+		self.source.switch_capture(capture)
+		self.capture = capture
+		for viewer in self._viewers:
+			capture.request_output_size(viewer, viewer._size)
+			previous.request_output_size(viewer, None)
+
+	def _start(self):
+		print("Starting video broadcast")
+		self.source = self.source_factory()
+		# 場面転換のキーフレーム要求も共有エンコーダーで受ける
+		self.source.request_keyframe = self.request_keyframe
+		self.capture = self.source.capture
+		self._codec = None
+		self._task = asyncio.ensure_future(self._run())
+
+	def _stop(self):
+		print("Stopping video broadcast")
+		task, self._task = self._task, None
+		source, self.source = self.source, None
+		if task is not None:
+			task.cancel()
+		if source is not None:
+			source.stop()
+
+	def _restart(self):
+		if self._viewers and self.source is None:
+			self._start()
+			# 作り直したソースのキャプチャにも視聴者の解像度の要求を伝える
+			for viewer in self._viewers:
+				self.capture.request_output_size(viewer, viewer._size)
+			self.request_keyframe()
+
+	def _encode(self, frame, force_keyframe):
+		started = time.perf_counter()
+		codec = self._codec
+		if codec is None or (frame.width, frame.height, self.bitrate) != (codec.width, codec.height, codec.bit_rate):
+			# 解像度かビットレートが変わったら開き直す（最初のフレームはキーフレームになる）
+			codec = self._codec = open_vp8_encoder(frame.width, frame.height, self.bitrate)
+		if force_keyframe:
+			frame.pict_type = av.video.frame.PictureType.I
+		packets = []
+		for packet in codec.encode(frame):
+			# RTCRtpSender は pts と time_base から RTP タイムスタンプを求める
+			packet.pts = frame.pts
+			packet.time_base = frame.time_base
+			packets.append(packet)
+		_ENCODE_SECONDS.observe(time.perf_counter() - started)
+		return packets
+
+	async def _run(self):
+		loop = asyncio.get_event_loop()
+		try:
+			while True:
+				frame = await self.source.recv()
+				force_keyframe = self._force_keyframe
+				self._force_keyframe = False
+				packets = await loop.run_in_executor(None, self._encode, frame, force_keyframe)
+				for packet in packets:
+					for viewer in list(self._viewers):
+						viewer._push(packet)
+		except (asyncio.CancelledError, MediaStreamError):
+			pass
+		except Exception as e:
+			print("Video broadcast error:", e)
+		finally:
+			# _stop で止めたのでなければ（エラーやソースの終了）ソースを止め、視聴者が残っていれば作り直す
+			if self._task is asyncio.current_task():
+				self._task = None
+				self._stop()
+				if self._viewers:
+					loop.call_later(RESTART_DELAY, self._restart)
+
+
+class BroadcastTrack(MediaStreamTrack):
+	"""VideoBroadcaster がエンコードしたパケットを 1 視聴者分受け取るトラック"""
+
+	kind = "video"
+
+	def __init__(self, broadcaster):
+		super().__init__()
+		self.broadcaster = broadcaster
+		self._queue = asyncio.Queue()
+		# キーフレームが届くまでの差分フレームは復号できないので捨てる
+		self._waiting_keyframe = True
+		# 最初のフレームを渡したときに呼ぶ関数（接続からの時間の計測用）
+		self.on_first_frame = None
+		# 要求している出力解像度の上限
+		self._size = None
+		running = broadcaster.running
+		broadcaster.subscribe(self)
+		# 配信もキャプチャも動いていなかったか（最初のフレームまでの時間の分類に使う）
+		self.cold_start = not running and broadcaster.source.cold_start
+		self._subscribed = True
+
+	@property
+	def capture(self):
+		"""映像ソースの共有キャプチャ（設定の変更で切り替わることがある）"""
+		return self.broadcaster.capture
+
+	@property
+	def fps(self):
+		"""共有エンコーダーへ送るフレームレート（全視聴者で共通。ソースを作り直している間は None）"""
+		source = self.broadcaster.source
+		return source.fps if source is not None else None
+
+	def request_keyframe(self):
+		self.broadcaster.request_keyframe()
+
+	def set_quality(self, size, fps=None):
+		"""出力解像度の上限を要求する（エンコードは全視聴者で共通のため fps は変えない）"""
+		self._size = size
+		self.capture.request_output_size(self, size)
+
+	def _push(self, packet):
+		if self._queue.qsize() >= self.broadcaster.queue_size:
+			# 送信が追いつかない。溜まった分を捨ててキーフレームからやり直す
+			while not self._queue.empty():
+				self._queue.get_nowait()
+			self._waiting_keyframe = True
+			self.broadcaster.request_keyframe()
+		self._queue.put_nowait(packet)
+
+	async def recv(self):
+		if self.readyState != "live":
+			raise MediaStreamError
+		while True:
+			packet = await self._queue.get()
+			if self._waiting_keyframe and not packet.is_keyframe:
+				continue
+			self._waiting_keyframe = False
+			break
+		if self.on_first_frame is not None:
+			callback, self.on_first_frame = self.on_first_frame, None
+			callback()
+		return packet
+
+	def stop(self):
+		super().stop()
+		if self._subscribed:
+			self._subscribed = False
+			self.capture.request_output_size(self, None)
+			self.broadcaster.unsubscribe(self)
@@ -0,0 +1,708 @@
+import asyncio
+import sys
+import threading
+import time
+import cv2
+import numpy as np
+import mss
+from aiortc.mediastreams import MediaStreamError
+from cursor import get_sprite
+from metrics import histogram
+
+# 差分検出・部分変換のタイル一辺（ピクセル）
+TILE_SIZE = 64
+# フレームバッファプールの上限（送信中のフレームが参照している間は再利用しない）
+FRAME_POOL_SIZE = 8
+# 止めたキャプチャスレッドを作り直すとき、最後のグラブが終わるのを待つ最長の秒数
+STOP_JOIN_TIMEOUT = 1.0
+
+
+# 段階ごとの処理時間（キャプチャスレッドで計測）
+_GRAB_SECONDS = histogram("capture_grab_seconds", "Screen grab and static check time")
+_CONVERT_SECONDS = histogram("capture_convert_seconds", "Scale, tile diff and BGRA to I420 conversion time")
+_CURSOR_SECONDS = histogram("capture_cursor_seconds", "Cursor composite time")
+
+
+def cursor_box(sprite, mx, my, width, height):
+	"""スプライトを (mx, my) に合成したとき描き換わる範囲 (x, y, w, h)。
+
+	I420 のクロマに合わせて偶数座標に揃える。width / height は偶数であること。
+	"""
+	x, y, w, h = sprite.box(mx, my)
+	x0 = max(x, 0) & ~1
+	y0 = max(y, 0) & ~1
+	x1 = min(x + w + 1, width) & ~1
+	y1 = min(y + h + 1, height) & ~1
+	if x1 <= x0 or y1 <= y0:
+		return None
+	return (x0, y0, x1 - x0, y1 - y0)
+
+
+def capture_rect(monitor, region=None):
+	"""グラブする範囲（画面座標）。region はモニター左上からの相対矩形で、モニター内に収める"""
+	if not region:
+		return dict(monitor)
+	left = max(int(region.get('left', 0)), 0)
+	top = max(int(region.get('top', 0)), 0)
+	width = min(int(region.get('width', monitor['width'])), monitor['width'] - left)
+	height = min(int(region.get('height', monitor['height'])), monitor['height'] - top)
+	if width <= 0 or height <= 0:
+		return dict(monitor)
+	return {
+		'left': monitor['left'] + left,
+		'top': monitor['top'] + top,
+		'width': width,
+		'height': height
+	}
+
+
+def fit_size(width, height, output_size=None):
+	"""縦横比を保って output_size (w, h) に収まる偶数サイズを返す（拡大はしない）"""
+	scale = 1.0
+	if output_size:
+		scale = min(output_size[0] / width, output_size[1] / height, 1.0)
+	return max(int(width * scale) & ~1, 2), max(int(height * scale) & ~1, 2)
+
+
+def i420_planes(buf, width, height):
+	"""I420 (yuv420p) バッファ (height * 3 / 2, width) を Y, U, V 平面のビューに分ける"""
+	flat = buf.reshape(-1)
+	size = width * height
+	y = flat[:size].reshape(height, width)
+	u = flat[size:size + size // 4].reshape(height // 2, width // 2)
+	v = flat[size + size // 4:].reshape(height // 2, width // 2)
+	return y, u, v
+
+
+def write_i420(planes, x, y, yuv):
+	"""cvtColor(..., COLOR_*2YUV_I420) で得た部分画像 yuv を planes の (x, y) に書き込む"""
+	h = yuv.shape[0] * 2 // 3
+	w = yuv.shape[1]
+	src = i420_planes(yuv, w, h)
+	planes[0][y:y + h, x:x + w] = src[0]
+	planes[1][y // 2:(y + h) // 2, x // 2:(x + w) // 2] = src[1]
+	planes[2][y // 2:(y + h) // 2, x // 2:(x + w) // 2] = src[2]
+
+
+def changed_tiles(cur, prev, tile=TILE_SIZE, out=None):
+	"""2 枚の BGRA 画像を比較し、変化したタイルの bool マップ (rows, cols) を返す
+
+	out には比較結果を書き込む作業用配列を渡せる（毎フレームの確保を避ける）。
+	"""
+	h, w = cur.shape[:2]
+	rows = -(-h // tile)
+	cols = -(-w // tile)
+	if prev is None or prev.shape != cur.shape:
+		return np.ones((rows, cols), bool)
+	# 幅が偶数なら 2 ピクセルずつ 64bit で比較する
+	dtype = np.uint64 if w % 2 == 0 else np.uint32
+	a = cur.reshape(h, -1).view(dtype)
+	b = prev.reshape(h, -1).view(dtype)
+	if out is None or out.shape != a.shape:
+		out = np.empty(a.shape, bool)
+	diff = np.not_equal(a, b, out=out)
+	per_tile = tile * 4 // np.dtype(dtype).itemsize
+	mask = np.zeros((rows, cols), bool)
+	# 変化のあったタイル行だけ列方向に集計する
+	bands = np.logical_or.reduceat(diff.any(axis=1), np.arange(0, h, tile))
+	for ty in np.flatnonzero(bands):
+		band = diff[ty * tile:(ty + 1) * tile].any(axis=0)
+		mask[ty] = np.logical_or.reduceat(band, np.arange(0, band.shape[0], per_tile))
+	return mask
+
+
+def mark_rect(mask, rect, tile=TILE_SIZE):
+	"""矩形 (x, y, w, h) に掛かるタイルを mask 上で True にする"""
+	if rect is None:
+		return
+	x, y, w, h = rect
+	mask[y // tile:(y + h - 1) // tile + 1, x // tile:(x + w - 1) // tile + 1] = True
+
+
+def tiles_to_rects(mask, width, height, tile=TILE_SIZE):
+	"""タイルマップを矩形 [(x, y, w, h), ...] にまとめる。
+
+	行ごとに連続したタイルを 1 つの区間とし、直上の行と同じ区間なら縦に伸ばす。
+	"""
+	rects = []
+	open_spans = {}
+	for ty in range(mask.shape[0]):
+		row = mask[ty]
+		spans = {}
+		if row.any():
+			edges = np.flatnonzero(np.diff(np.concatenate(([0], row.view(np.int8), [0]))))
+			for x0, x1 in zip(edges[::2].tolist(), edges[1::2].tolist()):
+				rect = open_spans.get((x0, x1))
+				if rect is None:
+					rect = [x0, ty, x1, ty + 1]
+					rects.append(rect)
+				else:
+					rect[3] = ty + 1
+				spans[(x0, x1)] = rect
+		open_spans = spans
+	return [
+		(x0 * tile, y0 * tile, min(x1 * tile, width) - x0 * tile, min(y1 * tile, height) - y0 * tile)
+		for x0, y0, x1, y1 in rects
+	]
+
+
+class SceneCutDetector:
+	"""縮小した輝度画像の差分で場面転換（背景・CG の切り替え）を検出する。
+
+	前フレームとの平均絶対差が threshold 以上なら即座に転換とみなす。
+	クロスフェードのように少しずつ変わる場合は、変化が始まる前の画面との差が
+	threshold を超えたまま前フレームとの差が settle 未満に落ち着いた時点で
+	転換とみなす。変化中でなければ、変化したタイルが min_changed の割合未満の
+	フレーム（テキストの表示など）は調べない。
+	"""
+
+	def __init__(self, threshold=12.0, settle=1.0, min_changed=0.1, size=(32, 18)):
+		self.threshold = threshold
+		self.settle = settle
+		self.min_changed = min_changed
+		self.size = size
+		self._prev = None
+		# 最後に落ち着いていた画面と、そこから変化中か
+		self._ref = None
+		self._changing = False
+
+	def update(self, luma, changed_ratio):
+		"""luma（Y 平面）と変化したタイルの割合から、このフレームが転換かを返す"""
+		if changed_ratio < self.min_changed and not self._changing and self._prev is not None:
+			return False
+		thumb = cv2.resize(luma, self.size, interpolation=cv2.INTER_AREA).astype(np.int16)
+		prev = self._prev
+		self._prev = thumb
+		if prev is None:
+			self._ref = thumb
+			return False
+		diff = float(np.abs(thumb - prev).mean())
+		if diff >= self.threshold:
+			self._ref = thumb
+			self._changing = False
+			return True
+		if diff >= self.settle:
+			# 変化中。基準は変化が始まる前の画面のまま保つ
+			self._changing = True
+			return False
+		drift = float(np.abs(thumb - self._ref).mean())
+		self._ref = thumb
+		self._changing = False
+		return drift >= self.threshold
+
+
+class FramePool:
+	"""I420 フレームバッファのプール。
+
+	バッファは VideoFrame.from_numpy_buffer でコピーせずに包んで送るため、
+	購読者やエンコーダーが参照している間は書き換えられない。参照の残って
+	いないバッファだけを貸し出し、足りなければ max_buffers まで増やす。
+	バッファごとに、最後に書いてから古くなったタイルと描き込んだカーソル範囲を持つ。
+	"""
+
+	def __init__(self, width, height, max_buffers=FRAME_POOL_SIZE):
+		self.width = width
+		self.height = height
+		self.tiles_shape = (-(-height // TILE_SIZE), -(-width // TILE_SIZE))
+		self.max_buffers = max_buffers
+		self.buffers = []
+		self.stale = []
+		self.cursor_boxes = []
+		# changed_tiles の作業用配列
+		self.diff = None
+		self._free_refs = None
+
+	def _refs(self, index):
+		return sys.getrefcount(self.buffers[index])
+
+	def acquire(self):
+		"""書き込めるバッファの番号を返す（全て使用中で増やせなければ None）"""
+		for index in range(len(self.buffers)):
+			if self._refs(index) <= self._free_refs:
+				return index
+		if len(self.buffers) >= self.max_buffers:
+			return None
+		self.buffers.append(np.zeros((self.height * 3 // 2, self.width), np.uint8))
+		self.stale.append(np.ones(self.tiles_shape, bool))
+		self.cursor_boxes.append(None)
+		index = len(self.buffers) - 1
+		if self._free_refs is None:
+			# 誰も参照していないときの参照数を基準にする
+			self._free_refs = self._refs(index)
+		return index
+
+	def mark(self, dirty):
+		"""全バッファに変化したタイルを記録する"""
+		for stale in self.stale:
+			stale |= dirty
+
+
+class CaptureFrame:
+	"""共有キャプチャが公開する 1 フレーム分の画像とメタデータ"""
+
+	__slots__ = ("image", "dirty", "seq", "time", "scene_cut")
+
+	def __init__(self, image, dirty, time, scene_cut=False):
+		# I420 画像 (height * 3 / 2, width)。購読者間で共有するため公開後は書き換えない
+		self.image = image
+		# 直前に公開したフレームから変化した矩形 [(x, y, w, h), ...]
+		self.dirty = dirty
+		self.seq = 0
+		# グラブ時刻（time.monotonic()）
+		self.time = time
+		# 場面転換を検出したフレームか
+		self.scene_cut = scene_cut
+
+
+class ScreenCapture:
+	"""モニター単位で共有する画面キャプチャ。
+
+	全ピアの ScreenTrack が同じインスタンスを購読し、最新フレームを
+	コピーせずに参照する。最初の購読で開始し、最後の購読解除で停止する。
+	mode="thread" ではグラブ・色変換・カーソル合成を専用スレッドで行い、
+	イベントループをブロックしない。mode="inline" は従来通りループ上で行う。
+
+	グラブした生データを前回と比較し、画面もカーソルも変わっていなければ
+	色変換を省略して前のフレームをそのまま残す。idle_delay 秒以上変化が
+	無ければ idle となり、購読側は keep-alive レートまで送信を落とす。
+
+	変化があった場合もタイル単位で差分を取り、変化したタイル（と移動した
+	カーソルの前後位置）だけをプールのフレームバッファへ再変換する。
+	変換は BGRA からエンコーダーが使う I420 へ直接行い、中間の BGR 画像は作らない。
+	変化領域は CaptureFrame.dirty として購読側に渡す。
+
+	region（モニター内の相対矩形、ゲームウィンドウのクライアント領域など）を
+	指定するとその範囲だけをグラブし、output_size を指定するとキャプチャ段階で
+	縮小してから変換する。カーソル座標も出力画像の座標へ写す。
+
+	backend を指定すると mss の代わりにそのキャプチャ元（synthetic.SyntheticScreen
+	など）からグラブする。画面の無い環境でのベンチマークや動作確認に使う。
+
+	scene_cut_threshold を指定すると SceneCutDetector で場面転換を調べ、
+	検出したフレームの CaptureFrame.scene_cut を立てて scene_cuts を数える。
+
+	linger を指定すると、最後の購読解除から linger 秒はキャプチャを止めずに待つ。
+	その間に再接続した購読者は、キャプチャの開き直しを待たずに最新フレームを受け取れる。
+	"""
+
+	def __init__(self, monitor_index, fps, cursor=None, cursor_scale=3.0, mode="thread", idle_delay=0.5, region=None, output_size=None, backend=None, scene_cut_threshold=0, linger=0):
+		self.monitor_index = monitor_index
+		# キャプチャ元を開く関数（mss.mss と同じく monitors と grab() を持つ with 文用のオブジェクトを返す）
+		self.backend = backend or mss.mss
+		self.fps = fps
+		self.frame_time = 1.0 / fps
+		# カーソル位置と形状（CursorState）。None ならカーソルを合成しない
+		self.cursor = cursor
+		self.cursor_scale = cursor_scale
+		self.mode = mode
+		self.idle_delay = idle_delay
+		self.capture_region = region
+		self.output_size = output_size
+		# 購読者ごとの出力解像度の要求（回線状況に合わせた縮小）と、実際に使う出力解像度
+		self._size_requests = {}
+		self._output = output_size
+		# 実際にグラブしている範囲（画面座標）。キャプチャ開始後に決まる
+		self.region = None
+		# 最新フレーム（CaptureFrame）の 1 枠スロット
+		self.frame = None
+		self.seq = 0
+		# 場面転換の検出（threshold が 0 なら無効）と、これまでに検出した回数
+		self.scene_cut_threshold = scene_cut_threshold
+		self._scene_cut = None
+		self.scene_cuts = 0
+		self._subscribers = 0
+		self.linger = linger
+		self._linger_handle = None
+		self._task = None
+		self._thread = None
+		self._stop_event = None
+		self._ready = None
+		self._changed = None
+		self._loop = None
+		# 変化検出用の前回グラブ結果
+		self._last_raw = None
+		self._last_cursor = None
+		self._reset_buffers()
+		self.last_activity = time.monotonic()
+
+	@property
+	def subscribers(self):
+		return self._subscribers
+
+	@property
+	def running(self):
+		"""キャプチャが動いているか（購読者が居なくても linger 中なら True）"""
+		return self._running()
+
+	@property
+	def idle(self):
+		"""一定時間、画面にもカーソルにも変化が無いか"""
+		return time.monotonic() - self.last_activity >= self.idle_delay
+
+	def poke(self):
+		"""入力などで画面が変わりそうなときに呼び、idle を解除する（スレッド安全）"""
+		self.last_activity = time.monotonic()
+		if self._loop is not None:
+			self._loop.call_soon_threadsafe(self._notify_change)
+
+	def _notify_change(self):
+		changed = self._changed
+		self._changed = asyncio.Event()
+		changed.set()
+
+	async def wait_change(self, timeout):
+		"""次の変化（または poke）を最大 timeout 秒待つ"""
+		try:
+			await asyncio.wait_for(self._changed.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+
+	def request_output_size(self, owner, size):
+		"""購読者 owner の出力解像度の上限 (w, h) を設定する（None で解除）。
+
+		キャプチャは全購読者で共有するため、要求と設定値のうち最も小さいものを適用する。
+		次のグラブから新しい解像度で変換する（再ネゴシエーションは不要）。
+		"""
+		if size is None:
+			self._size_requests.pop(owner, None)
+		else:
+			self._size_requests[owner] = tuple(size)
+		self._update_output()
+
+	def set_output_size(self, size):
+		"""設定値の出力解像度の上限を変更する（動作中でも次のグラブから反映）"""
+		self.output_size = size
+		self._update_output()
+
+	def set_fps(self, fps):
+		"""グラブのフレームレートを変更する（動作中でも次の周期から反映）"""
+		self.fps = fps
+		self.frame_time = 1.0 / fps
+
+	def _update_output(self):
+		sizes = list(self._size_requests.values())
+		if self.output_size:
+			sizes.append(tuple(self.output_size))
+		output = min(sizes, key=lambda s: s[0] * s[1]) if sizes else None
+		if output != self._output:
+			self._output = output
+			# 画面が静止していても新しい解像度のフレームを作るよう、前回のグラブ結果を捨てる
+			self._last_raw = None
+			print(f"Capture output size: {output}")
+
+	def _running(self):
+		if self._task is not None and not self._task.done():
+			return True
+		if self._thread is not None and self._thread.is_alive() and not self._stop_event.is_set():
+			return True
+		return False
+
+	def subscribe(self):
+		self._subscribers += 1
+		if self._linger_handle is not None:
+			self._linger_handle.cancel()
+			self._linger_handle = None
+		if not self._running():
+			self._start()
+
+	def unsubscribe(self):
+		if self._subscribers == 0:
+			return
+		self._subscribers -= 1
+		if self._subscribers == 0:
+			if self.linger > 0 and self._loop is not None:
+				# 再接続に備えて linger 秒は止めずに待つ
+				self._linger_handle = self._loop.call_later(self.linger, self._stop_lingering)
+			else:
+				self._stop()
+
+	def _stop_lingering(self):
+		self._linger_handle = None
+		if self._subscribers == 0:
+			self._stop()
+
+	def close(self):
+		"""購読者が残っていてもすぐに止め、以後は保持しない（作り直したキャプチャと同時にグラブしない）"""
+		self.linger = 0
+		if self._linger_handle is not None:
+			self._linger_handle.cancel()
+			self._linger_handle = None
+		self._stop()
+
+	def _start(self):
+		print(f"Starting screen capture (monitor={self.monitor_index}, mode={self.mode})")
+		if self._thread is not None:
+			# 止めたばかりのスレッドが最後のグラブを終えるまで待つ（同じバッファに 2 つのスレッドが書かないように）
+			self._thread.join(STOP_JOIN_TIMEOUT)
+			if self._thread.is_alive():
+				print(f"Previous capture thread did not stop in {STOP_JOIN_TIMEOUT}s (monitor={self.monitor_index})")
+			self._thread = None
+		self._loop = asyncio.get_event_loop()
+		self._ready = asyncio.Event()
+		self._changed = asyncio.Event()
+		self._stop_event = threading.Event()
+		self._last_raw = None
+		self._last_cursor = None
+		self._reset_buffers()
+		self._scene_cut = SceneCutDetector(self.scene_cut_threshold) if self.scene_cut_threshold > 0 else None
+		self.last_activity = time.monotonic()
+		if self.mode == "inline":
+			self._task = self._loop.create_task(self._run_inline(self._stop_event, self._ready))
+		else:
+			self._thread = threading.Thread(
+				target=self._run_thread,
+				args=(self._stop_event, self._ready),
+				name=f"ScreenCapture-{self.monitor_index}",
+				daemon=True
+			)
+			self._thread.start()
+
+	def _stop(self):
+		if not self._running():
+			return
+		print(f"Stopping screen capture (monitor={self.monitor_index})")
+		if self._stop_event is not None:
+			self._stop_event.set()
+		if self._task is not None:
+			self._task.cancel()
+			self._task = None
+		# スレッドは停止フラグを見て自分で抜ける（ここでは join せず、作り直すときに _start で待つ）
+		self.frame = None
+
+	async def latest(self):
+		"""最新フレームを返す（最初のフレームが揃うまでは待つ。揃う前に止まったら MediaStreamError）"""
+		while self.frame is None:
+			if not self._running():
+				raise MediaStreamError
+			# 作り直された場合は新しいキャプチャの最初のフレームを待ち直す
+			await self._ready.wait()
+		return self.frame
+
+	def _publish(self, frame, stop_event):
+		if stop_event.is_set():
+			return
+		first = self.frame is None
+		self.seq += 1
+		frame.seq = self.seq
+		# 参照の差し替えのみ（スロットは常に最新 1 枚）
+		self.frame = frame
+		self.last_activity = time.monotonic()
+		if first:
+			self._loop.call_soon_threadsafe(self._ready.set)
+		self._loop.call_soon_threadsafe(self._notify_change)
+
+	def _reset_buffers(self):
+		self._pool = None
+		self._prev_img = None
+		self._cursor_box = None
+		# 縮小先の BGRA バッファ（前回の画像と比較するため 2 面を交互に使う）
+		self._scaled = []
+
+	def _grab_rect(self, sct):
+		monitor = sct.monitors[self.monitor_index]
+		rect = capture_rect(monitor, self.capture_region)
+		self.region = rect
+		print(f"Capture region: {rect} -> output {fit_size(rect['width'], rect['height'], self._output)}")
+		return rect
+
+	def _scale(self, img):
+		"""output_size に合わせて縮小した BGRA 画像を返す（不要ならそのまま返す）"""
+		h, w = img.shape[:2]
+		out_w, out_h = fit_size(w, h, self._output)
+		if (out_w, out_h) == (w & ~1, h & ~1):
+			return img
+		if not self._scaled or self._scaled[0].shape[:2] != (out_h, out_w):
+			self._scaled = [np.empty((out_h, out_w, 4), np.uint8) for _ in range(2)]
+		self._scaled.reverse()
+		dst = self._scaled[0]
+		cv2.resize(img, (out_w, out_h), dst=dst, interpolation=cv2.INTER_AREA)
+		return dst
+
+	def _cursor(self, monitor):
+		"""monitor 座標系でのカーソル (x, y, 形状名)。位置が不明なら None"""
+		if self.cursor is None:
+			return None
+		position, shape = self.cursor.poll()
+		if position is None:
+			return None
+		# monitor の左上オフセットを引く
+		return position[0] - monitor.get('left', 0), position[1] - monitor.get('top', 0), shape
+
+	def _grab(self, sct, monitor):
+		"""1 回グラブし、変化があれば CaptureFrame を、無ければ None を返す"""
+		grabbed_at = time.monotonic()
+		started = time.perf_counter()
+		shot = sct.grab(monitor)
+		cursor = raw_cursor = self._cursor(monitor)
+		# 生データ（bytearray）の比較は memcmp で済むため色変換より十分安い
+		same = shot.raw == self._last_raw
+		grabbed = time.perf_counter()
+		_GRAB_SECONDS.observe(grabbed - started)
+		if self.frame is not None and same and cursor == self._last_cursor:
+			return None
+		img = np.asarray(shot)
+		src_h, src_w = img.shape[:2]
+		# 出力の大きさ（I420 は縦横とも偶数が必要なため、奇数なら端の 1 ピクセルを落とす）
+		w, h = fit_size(src_w, src_h, self._output)
+		pool = self._pool
+		if pool is None or (pool.width, pool.height) != (w, h):
+			self._reset_buffers()
+			pool = self._pool = FramePool(w, h)
+		# 縮小より先にバッファを借りる（縮小先は前回の画像と交互に使うため、捨てるフレームで上書きしない）
+		index = pool.acquire()
+		if index is None:
+			# 全バッファが送信中。今回は捨て、差分は次のグラブでまとめて扱う
+			return None
+		img = self._scale(img)
+		ratio = img.shape[1] / src_w
+		img = img[:h, :w]
+		# カーソル座標とスプライトの大きさを出力画像に合わせる
+		if cursor is not None and ratio != 1.0:
+			cursor = (int(cursor[0] * ratio), int(cursor[1] * ratio), cursor[2])
+		if same:
+			dirty = np.zeros(pool.tiles_shape, bool)
+		else:
+			if pool.diff is None:
+				pool.diff = np.empty((h, w // 2), bool)
+			dirty = changed_tiles(img, self._prev_img, out=pool.diff)
+		# カーソルの移動は前後の位置だけを変化として扱う
+		box = None
+		if cursor is not None:
+			sprite = get_sprite(cursor[2], round(self.cursor_scale * ratio, 2))
+			box = cursor_box(sprite, cursor[0], cursor[1], w, h)
+		if raw_cursor != self._last_cursor:
+			mark_rect(dirty, self._cursor_box)
+			mark_rect(dirty, box)
+		pool.mark(dirty)
+		# 借りたバッファの古くなったタイル（前に描いたカーソルを含む）だけ変換する
+		buf = pool.buffers[index]
+		stale = pool.stale[index]
+		mark_rect(stale, pool.cursor_boxes[index])
+		rects = tiles_to_rects(stale, w, h)
+		if rects == [(0, 0, w, h)]:
+			cv2.cvtColor(img, cv2.COLOR_BGRA2YUV_I420, dst=buf)
+			planes = i420_planes(buf, w, h)
+		else:
+			planes = i420_planes(buf, w, h)
+			for x, y, rw, rh in rects:
+				write_i420(planes, x, y, cv2.cvtColor(img[y:y + rh, x:x + rw], cv2.COLOR_BGRA2YUV_I420))
+		stale[:] = False
+		# 場面転換の検出（カーソルを重ねる前の輝度で調べる）
+		scene_cut = False
+		if self._scene_cut is not None and not same:
+			scene_cut = self._scene_cut.update(buf[:h], float(dirty.mean()))
+			if scene_cut:
+				self.scene_cuts += 1
+		converted = time.perf_counter()
+		_CONVERT_SECONDS.observe(converted - grabbed)
+		# カーソル合成: カーソル周辺だけ BGR にしてスプライトを重ね、変換する
+		if box is not None:
+			bx, by, bw, bh = box
+			patch = cv2.cvtColor(img[by:by + bh, bx:bx + bw], cv2.COLOR_BGRA2BGR)
+			sprite.blend(patch, cursor[0] - bx, cursor[1] - by)
+			write_i420(planes, bx, by, cv2.cvtColor(patch, cv2.COLOR_BGR2YUV_I420))
+			_CURSOR_SECONDS.observe(time.perf_counter() - converted)
+		pool.cursor_boxes[index] = box
+		self._cursor_box = box
+		self._prev_img = img
+		self._last_raw = shot.raw
+		self._last_cursor = raw_cursor
+		return CaptureFrame(buf, tiles_to_rects(dirty, w, h), grabbed_at, scene_cut)
+
+	def _step(self, sct, monitor, stop_event):
+		frame = self._grab(sct, monitor)
+		if frame is not None:
+			self._publish(frame, stop_event)
+
+	def _run_thread(self, stop_event, ready):
+		try:
+			# mss のハンドルはスレッドごとに作成する（合成・再生のキャプチャ元も同様）
+			with self.backend() as sct:
+				monitor = self._grab_rect(sct)
+				next_time = time.monotonic()
+				while not stop_event.is_set():
+					self._step(sct, monitor, stop_event)
+					next_time += self.frame_time
+					wait = next_time - time.monotonic()
+					if wait > 0:
+						stop_event.wait(wait)
+					else:
+						# 遅れている場合は予定時刻をリセットする
+						next_time = time.monotonic()
+		except Exception as e:
+			print(f"Screen capture error (monitor={self.monitor_index}): {e}")
+		finally:
+			# 最初のフレームの前に止まっても、latest() で待っている側を起こす
+			stop_event.set()
+			try:
+				self._loop.call_soon_threadsafe(ready.set)
+			except RuntimeError:
+				# イベントループが既に閉じている
+				pass
+
+	async def _run_inline(self, stop_event, ready):
+		loop = asyncio.get_event_loop()
+		try:
+			with self.backend() as sct:
+				monitor = self._grab_rect(sct)
+				next_time = loop.time()
+				while not stop_event.is_set():
+					self._step(sct, monitor, stop_event)
+					next_time += self.frame_time
+					wait = next_time - loop.time()
+					if wait > 0:
+						await asyncio.sleep(wait)
+					else:
+						# 遅れている場合は予定時刻をリセットする
+						next_time = loop.time()
+						await asyncio.sleep(0)
+		except asyncio.CancelledError:
+			pass
+		except Exception as e:
+			print(f"Screen capture error (monitor={self.monitor_index}): {e}")
+		finally:
+			stop_event.set()
+			ready.set()
+
+
+# モニター番号ごとの共有キャプチャ
+_captures = {}
+
+
+def get_screen_capture(monitor_index, fps, cursor=None, cursor_scale=3.0, mode="thread", idle_delay=0.5, region=None, output_size=None, backend=None, scene_cut_threshold=0, linger=0):
+	"""モニター番号に対応する共有 ScreenCapture を返す（無ければ作成）"""
+	capture = _captures.get(monitor_index)
+	if capture is None:
+		capture = ScreenCapture(
+			monitor_index, fps,
+			cursor=cursor,
+			cursor_scale=cursor_scale,
+			mode=mode,
+			idle_delay=idle_delay,
+			region=region,
+			output_size=output_size,
+			backend=backend,
+			scene_cut_threshold=scene_cut_threshold,
+			linger=linger
+		)
+		_captures[monitor_index] = capture
+	return capture
+
+
+def screen_captures():
+	"""作成済みの共有 ScreenCapture の一覧"""
+	return list(_captures.values())
+
+
+def discard_screen_capture(monitor_index):
+	"""モニター番号の共有キャプチャを一覧から外してすぐに止める（次の get_screen_capture で作り直す）"""
+	capture = _captures.pop(monitor_index, None)
+	if capture is not None:
+		capture.close()
+	return capture
+
+
+def monitor_count(backend=None):
+	"""キャプチャ元の monitors の数（番号 0 は全モニターを合わせた範囲で、使える番号は 0〜数-1）"""
+	with (backend or mss.mss)() as sct:
+		return len(sct.monitors)
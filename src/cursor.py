@@ -0,0 +1,187 @@
+import ctypes
+import functools
+import time
+import cv2
+import numpy as np
+
+
+class CursorSprite:
+	"""事前に描画したカーソル画像。
+
+	color は乗算済みアルファの BGR（float32）、inv_alpha は 1 - alpha。
+	hotspot はスプライト内でカーソル位置に合わせる点 (x, y)。
+	"""
+
+	def __init__(self, color, alpha, hotspot):
+		self.color = color.astype(np.float32)
+		self.inv_alpha = (1.0 - alpha.astype(np.float32))[..., None]
+		self.hotspot = hotspot
+		self.height, self.width = alpha.shape[:2]
+
+	def box(self, x, y):
+		"""カーソル位置 (x, y) のときスプライトが覆う範囲 (x, y, w, h)"""
+		return (x - self.hotspot[0], y - self.hotspot[1], self.width, self.height)
+
+	def blend(self, patch, x, y):
+		"""BGR 画像 patch の (x, y) にホットスポットが来るよう合成する"""
+		left = x - self.hotspot[0]
+		top = y - self.hotspot[1]
+		h, w = patch.shape[:2]
+		x0 = max(left, 0)
+		y0 = max(top, 0)
+		x1 = min(left + self.width, w)
+		y1 = min(top + self.height, h)
+		if x1 <= x0 or y1 <= y0:
+			return
+		sx = slice(x0 - left, x1 - left)
+		sy = slice(y0 - top, y1 - top)
+		region = patch[y0:y1, x0:x1]
+		blended = region * self.inv_alpha[sy, sx] + self.color[sy, sx]
+		np.add(blended, 0.5, out=blended)
+		region[...] = blended.astype(np.uint8)
+
+
+def _two_tone_sprite(outer_mask, inner_mask, hotspot):
+	"""黒の外形（outer）の上に白の内側（inner）を重ねたスプライトを作る"""
+	a_outer = outer_mask.astype(np.float32) / 255.0
+	a_inner = inner_mask.astype(np.float32) / 255.0
+	alpha = 1.0 - (1.0 - a_outer) * (1.0 - a_inner)
+	color = np.repeat((a_inner * 255.0)[..., None], 3, axis=2)
+	return CursorSprite(color, alpha, hotspot)
+
+
+def render_arrow(scale):
+	"""従来の fillPoly と同じ形の矢印（先端がホットスポット）"""
+	s = scale
+	pad = 1
+	size = int(18 * s) + 2 * pad + 1
+	outer = np.zeros((size, size), np.uint8)
+	inner = np.zeros((size, size), np.uint8)
+	pts_outer = np.array([
+		[pad, pad],
+		[pad + int(18 * s), pad + int(8 * s)],
+		[pad + int(8 * s), pad + int(18 * s)]
+	], np.int32).reshape((-1, 1, 2))
+	cv2.fillPoly(outer, [pts_outer], 255, lineType=cv2.LINE_AA)
+	pts_inner = np.array([
+		[pad + int(2 * s), pad + int(2 * s)],
+		[pad + int(14 * s), pad + int(7 * s)],
+		[pad + int(7 * s), pad + int(14 * s)]
+	], np.int32).reshape((-1, 1, 2))
+	cv2.fillPoly(inner, [pts_inner], 255, lineType=cv2.LINE_AA)
+	return _two_tone_sprite(outer, inner, (pad, pad))
+
+
+def render_hand(scale):
+	"""選択肢の上などで使う指差しの手（人差し指の先がホットスポット）"""
+	s = scale
+	# 収縮処理が画像端の影響を受けないよう余白を取る
+	border = max(int(1.5 * s), 1)
+	pad = border + 1
+	outline = [
+		(6, 0), (8, 0), (9, 1), (9, 7), (15, 8), (16, 9), (16, 15),
+		(13, 19), (6, 19), (1, 13), (1, 11), (3, 10), (5, 12), (5, 1)
+	]
+	size = int(19 * s) + 2 * pad + 1
+	outer = np.zeros((size, size), np.uint8)
+	pts = np.array([[pad + int(x * s), pad + int(y * s)] for x, y in outline], np.int32).reshape((-1, 1, 2))
+	cv2.fillPoly(outer, [pts], 255, lineType=cv2.LINE_AA)
+	# 外形を縮めて白い内側にする
+	inner = cv2.erode(outer, np.ones((2 * border + 1, 2 * border + 1), np.uint8))
+	return _two_tone_sprite(outer, inner, (pad + int(7 * s), pad))
+
+
+# カーソル形状名 → スプライト生成関数 (scale -> CursorSprite)
+CURSOR_SHAPES = {
+	"arrow": render_arrow,
+	"hand": render_hand,
+}
+
+
+def register_cursor_shape(name, render):
+	"""カーソル形状を追加・差し替える。render は scale を受け取り CursorSprite を返す"""
+	CURSOR_SHAPES[name] = render
+	get_sprite.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def get_sprite(shape, scale):
+	"""形状と拡大率に対応するスプライト（一度だけ描画してキャッシュする）"""
+	render = CURSOR_SHAPES.get(shape, render_arrow)
+	return render(scale)
+
+
+class _CURSORINFO(ctypes.Structure):
+	_fields_ = [
+		("cbSize", ctypes.c_uint32),
+		("flags", ctypes.c_uint32),
+		("hCursor", ctypes.c_void_p),
+		("ptScreenPos", ctypes.c_long * 2),
+	]
+
+
+@functools.lru_cache(maxsize=None)
+def _system_cursor(cursor_id):
+	"""共有システムカーソルのハンドル（LoadCursor の結果は変わらないのでキャッシュする）"""
+	user32 = ctypes.windll.user32
+	user32.LoadCursorW.restype = ctypes.c_void_p
+	return user32.LoadCursorW(None, ctypes.c_void_p(cursor_id))
+
+
+def windows_cursor_shape():
+	"""Windows の現在のシステムカーソルから形状名を返す（取得できなければ None）"""
+	try:
+		user32 = ctypes.windll.user32
+	except Exception:
+		return None
+	try:
+		info = _CURSORINFO()
+		info.cbSize = ctypes.sizeof(_CURSORINFO)
+		if not user32.GetCursorInfo(ctypes.byref(info)):
+			return None
+		if info.hCursor == _system_cursor(32649):  # IDC_HAND
+			return "hand"
+		return "arrow"
+	except Exception:
+		return None
+
+
+class CursorState:
+	"""キャプチャが合成するカーソル位置と形状のキャッシュ。
+
+	入力処理がマウスを動かすたびに update() で位置を更新し、キャプチャ側は
+	poll() でこの値を読むだけにする。ホスト側でマウスが直接動かされた場合に
+	備え、refresh_interval 秒ごとに source から位置を読み直す。
+	形状は安価に取得できるため shape_source から毎回読む。
+	"""
+
+	def __init__(self, source=None, shape_source=None, refresh_interval=0.5):
+		self.source = source
+		self.shape_source = shape_source
+		self.refresh_interval = refresh_interval
+		self.position = None
+		self.shape = "arrow"
+		self._refreshed = 0.0
+
+	def update(self, position, shape=None):
+		self.position = (int(position[0]), int(position[1]))
+		if shape is not None:
+			self.shape = shape
+		self._refreshed = time.monotonic()
+
+	def poll(self):
+		"""(position, shape) を返す。必要なら source から読み直す"""
+		now = time.monotonic()
+		if self.source is not None and now - self._refreshed >= self.refresh_interval:
+			self._refreshed = now
+			try:
+				position = self.source()
+				self.position = (int(position[0]), int(position[1]))
+			except Exception:
+				pass
+		if self.shape_source is not None:
+			try:
+				self.shape = self.shape_source() or "arrow"
+			except Exception:
+				pass
+		return self.position, self.shape
@@ -1,9 +1,12 @@
 import tkinter as tk
 from tkinter import messagebox
+from collections import deque
 import json
 import subprocess
 import os
 import socket
+import sys
+import time
 
 # 設定ファイルのパス
 CONFIG_FILE = "src/config.json"
@@ -19,22 +22,33 @@ default_settings = {
 
 # サーバープロセス
 server_process = None
+# シグナリングサーバーのポート（server.py と同じ）
+SIGNALING_PORT = 8765
+# 起動ボタンを押してから接続を受け付けるまでを待つ上限（秒）
+SERVER_READY_TIMEOUT = 30
+# サーバーから統計を受け取る UDP ソケット（サーバー起動時に作成）と、表示の更新間隔（ミリ秒）
+stats_socket = None
+STATS_POLL_MS = 500
+# スパークラインに残す点の数（約 30 秒分）
+SPARKLINE_POINTS = 60
 
 # 設定を保存する関数
 def save_settings():
     try:
         print(f"設定ファイルのパス: {CONFIG_FILE}")  # デバッグ用
-        settings = {
+        # GUI で編集しない項目（CAPTURE_MODE など）は既存の値を保持する
+        settings = load_settings()
+        settings.update({
             "SCREEN_FPS": int(screen_fps_entry.get()),
             "SCREEN_MONITOR_INDEX": int(screen_monitor_entry.get()),
             "AUDIO_SAMPLE_RATE": int(audio_sample_rate_entry.get()),
             "AUDIO_CHANNELS": int(audio_channels_entry.get()),
             "SERVER_IP": server_ip_entry.get()
-        }
+        })
         with open(CONFIG_FILE, "w") as f:
             json.dump(settings, f, indent=4)
         print("設定が正常に保存されました")  # デバッグ用
-        messagebox.showinfo("保存完了", "設定が保存されました！")
+        messagebox.showinfo("保存完了", "設定が保存されました！\n起動中のサーバーにもそのまま反映されます。")
     except Exception as e:
         messagebox.showerror("エラー", f"設定の保存中にエラーが発生しました: {e}")
         print(f"エラー詳細: {e}")
@@ -53,25 +67,194 @@ def start_server():
     if server_process is None:
         try:
             server_path = os.path.join(os.path.dirname(__file__), "server.py")
-            server_process = subprocess.Popen(["python", server_path], cwd=os.path.dirname(__file__))
-            messagebox.showinfo("サーバー起動", "サーバーが起動しました！")
-            server_status_label.config(text="サーバー状態: 起動中", fg="green")
+            # GUI と同じ Python で起動する（PATH 上の別の python を探さない）
+            open_stats_socket()
+            server_process = subprocess.Popen(
+                [sys.executable, server_path, "--stats-port", str(stats_socket.getsockname()[1])],
+                cwd=os.path.dirname(__file__)
+            )
+            server_status_label.config(text="サーバー状態: 起動待ち...", fg="orange")
+            root.after(20, wait_server_ready, server_process, time.perf_counter())
         except Exception as e:
             messagebox.showerror("エラー", f"サーバーの起動に失敗しました: {e}")
     else:
         messagebox.showwarning("警告", "サーバーは既に起動しています！")
 
+# シグナリングのポートが接続を受け付けるまで待ち、起動にかかった時間を表示する関数
+def wait_server_ready(process, clicked):
+    if process is not server_process:
+        return
+    if process.poll() is not None:
+        server_status_label.config(text="サーバー状態: 起動に失敗しました", fg="red")
+        return
+    try:
+        socket.create_connection(("127.0.0.1", SIGNALING_PORT), timeout=0.05).close()
+    except OSError:
+        if time.perf_counter() - clicked < SERVER_READY_TIMEOUT:
+            root.after(20, wait_server_ready, process, clicked)
+        else:
+            server_status_label.config(text="サーバー状態: 応答がありません", fg="red")
+        return
+    elapsed_ms = (time.perf_counter() - clicked) * 1000
+    print(f"サーバーが接続を受け付けるまで: {elapsed_ms:.0f} ms")
+    server_status_label.config(text=f"サーバー状態: 起動中（接続可能になるまで {elapsed_ms:.0f} ms）", fg="green")
+
 # サーバーを停止する関数
 def stop_server():
     global server_process
     if server_process is not None:
         server_process.terminate()
         server_process = None
+        close_stats_socket()
         messagebox.showinfo("サーバー停止", "サーバーを停止しました！")
         server_status_label.config(text="サーバー状態: 停止中", fg="red")
     else:
         messagebox.showwarning("警告", "サーバーは起動していません！")
 
+# ---- パフォーマンス表示 ----
+# サーバーは metrics.publish_stats で全メトリクスの要約（JSON）を送ってくる。
+# ヒストグラムは起動からの累積なので、前回との count・sum の差から直近の平均を求める
+
+# 統計を受け取るソケットを開く関数（ポートは OS に選ばせ、起動引数でサーバーに伝える）
+def open_stats_socket():
+    global stats_socket, last_stats
+    close_stats_socket()
+    stats_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stats_socket.bind(("127.0.0.1", 0))
+    stats_socket.setblocking(False)
+    last_stats = None
+
+def close_stats_socket():
+    global stats_socket
+    if stats_socket is not None:
+        stats_socket.close()
+        stats_socket = None
+    for label, history, canvas in zip(stats_value_labels, stats_history, stats_canvases):
+        label.config(text="-")
+        history.clear()
+        canvas.delete("all")
+
+# 前回 count・sum の差から求めた平均（ミリ秒）。区間内に記録が無ければ None
+def interval_avg_ms(current, previous, name):
+    cur = current.get(name)
+    prev = (previous or {}).get(name) or {"count": 0, "sum": 0.0}
+    if not cur or cur["count"] <= prev["count"]:
+        return None
+    return (cur["sum"] - prev["sum"]) / (cur["count"] - prev["count"]) * 1000
+
+# ゲージの値をラベル（"peer=1,kind=video" など）→ 値の dict で返す（kind を指定するとその種類だけ）
+def gauge_values(current, name, kind=None):
+    values = current.get(name) or {}
+    if kind is not None:
+        values = {k: v for k, v in values.items() if f"kind={kind}" in k}
+    return {k: v for k, v in values.items() if v is not None}
+
+def format_values(values, fmt):
+    return " / ".join(fmt.format(v) for v in values) if values else "-"
+
+# 各行: 表示名と、(表示する文字列, スパークラインに描く値) を返す関数
+def stats_fps(cur, prev):
+    values = list(gauge_values(cur, "video_achieved_fps").values())
+    return format_values(values, "{:.1f}"), min(values) if values else None
+
+def stats_capture(cur, prev):
+    grab = interval_avg_ms(cur, prev, "capture_grab_seconds")
+    convert = interval_avg_ms(cur, prev, "capture_convert_seconds")
+    cursor = interval_avg_ms(cur, prev, "capture_cursor_seconds")
+    if grab is None:
+        return "-", None
+    total = grab + (convert or 0.0) + (cursor or 0.0)
+    return f"{total:.1f}（取得 {grab:.1f} / 変換 {convert or 0.0:.1f} / カーソル {cursor or 0.0:.1f}）", total
+
+def stats_encode(cur, prev):
+    # 配信モードは共有エンコーダーの時間、それ以外は接続ごとのエンコード・送信の時間
+    value = interval_avg_ms(cur, prev, "video_broadcast_encode_seconds")
+    if value is None:
+        value = interval_avg_ms(cur, prev, "video_encode_send_seconds")
+    return ("-", None) if value is None else (f"{value:.1f}", value)
+
+def stats_bitrate(cur, prev):
+    values = [v / 1000 for v in gauge_values(cur, "webrtc_send_bitrate_bps", "video").values()]
+    return format_values(values, "{:.0f}"), sum(values) if values else None
+
+def stats_rtt(cur, prev):
+    values = [v * 1000 for v in gauge_values(cur, "webrtc_rtt_seconds", "video").values()]
+    return format_values(values, "{:.0f}"), max(values) if values else None
+
+def stats_loss(cur, prev):
+    values = [v * 100 for v in gauge_values(cur, "webrtc_fraction_lost", "video").values()]
+    return format_values(values, "{:.1f}"), max(values) if values else None
+
+def stats_audio(cur, prev):
+    value = interval_avg_ms(cur, prev, "audio_queue_delay_seconds")
+    return ("-", None) if value is None else (f"{value:.1f}", value)
+
+def stats_audio_underruns(cur, prev):
+    values = list(gauge_values(cur, "audio_underruns").values())
+    return format_values(values, "{:.0f}"), sum(values) if values else None
+
+def stats_input(cur, prev):
+    value = interval_avg_ms(cur, prev, "input_dispatch_seconds")
+    return ("-", None) if value is None else (f"{value:.2f}", value)
+
+STATS_ROWS = [
+    ("実効フレームレート (fps)", stats_fps),
+    ("キャプチャ (ms)", stats_capture),
+    ("エンコード・送信 (ms)", stats_encode),
+    ("映像ビットレート (kbps)", stats_bitrate),
+    ("RTT (ms)", stats_rtt),
+    ("損失率 (%)", stats_loss),
+    ("音声バッファ (ms)", stats_audio),
+    ("音声の途切れ (回)", stats_audio_underruns),
+    ("入力遅延 (ms)", stats_input),
+]
+
+# 直前に受け取った統計と、行ごとの履歴・表示部品
+last_stats = None
+stats_history = [deque(maxlen=SPARKLINE_POINTS) for _ in STATS_ROWS]
+stats_value_labels = []
+stats_canvases = []
+
+def draw_sparkline(canvas, history):
+    canvas.delete("all")
+    points = [v for v in history if v is not None]
+    if len(points) < 2:
+        return
+    width = int(canvas["width"])
+    height = int(canvas["height"])
+    top = max(points) or 1.0
+    step = width / (SPARKLINE_POINTS - 1)
+    offset = SPARKLINE_POINTS - len(history)
+    coords = []
+    for i, v in enumerate(history):
+        if v is None:
+            continue
+        coords += [(offset + i) * step, height - 2 - (height - 4) * v / top]
+    if len(coords) >= 4:
+        canvas.create_line(*coords, fill="#2a7", width=1)
+
+# 届いている統計を読み、表示を更新する関数（ソケットはノンブロッキングなので mainloop を止めない）
+def poll_stats():
+    global last_stats
+    latest = None
+    while stats_socket is not None:
+        try:
+            data = stats_socket.recv(65536)
+        except (BlockingIOError, OSError):
+            break
+        try:
+            latest = json.loads(data)
+        except ValueError:
+            continue
+    if latest is not None:
+        for i, (_, row) in enumerate(STATS_ROWS):
+            text, value = row(latest, last_stats)
+            stats_value_labels[i].config(text=text)
+            stats_history[i].append(value)
+            draw_sparkline(stats_canvases[i], stats_history[i])
+        last_stats = latest
+    root.after(STATS_POLL_MS, poll_stats)
+
 # IPv4アドレスを取得する関数
 def get_ipv4_address():
     try:
@@ -134,5 +317,18 @@ stop_button.grid(row=6, column=1)
 server_status_label = tk.Label(root, text="サーバー状態: 停止中", fg="red")
 server_status_label.grid(row=7, column=0, columnspan=2)
 
+# パフォーマンス表示（サーバー起動中に更新）
+stats_frame = tk.LabelFrame(root, text="パフォーマンス")
+stats_frame.grid(row=8, column=0, columnspan=2, sticky="we", padx=4, pady=4)
+for i, (title, _) in enumerate(STATS_ROWS):
+    tk.Label(stats_frame, text=title).grid(row=i, column=0, sticky="w")
+    value_label = tk.Label(stats_frame, text="-", width=36, anchor="e")
+    value_label.grid(row=i, column=1, sticky="e")
+    stats_value_labels.append(value_label)
+    canvas = tk.Canvas(stats_frame, width=120, height=20, bg="white", highlightthickness=0)
+    canvas.grid(row=i, column=2, padx=4, pady=1)
+    stats_canvases.append(canvas)
+root.after(STATS_POLL_MS, poll_stats)
+
 # GUIの起動
 root.mainloop()
\ No newline at end of file
@@ -0,0 +1,303 @@
+import ctypes
+import queue
+import struct
+import threading
+import time
+import numpy as np
+from metrics import histogram
+
+
+# バイナリ入力プロトコル（version 1, little endian）
+#   ヘッダ 4 バイト: version (u8), reserved (u8), イベント数 (u16)
+#   イベント 12 バイト × イベント数: op (u8), button (u8), reserved (u16), dx (i32), dy (i32)
+# dx/dy は INPUT_FIXED_ONE を 1.0 とする固定小数点。move は正規化した相対移動、
+# wheel はピクセル単位のスクロール量。1 メッセージに複数のイベントを詰められる。
+INPUT_PROTOCOL_VERSION = 1
+INPUT_FIXED_ONE = 1 << 16
+
+OP_MOVE = 1
+OP_CLICK = 2
+OP_DOWN = 3
+OP_UP = 4
+OP_WHEEL = 5
+
+_ACTION_OPS = {'click': OP_CLICK, 'down': OP_DOWN, 'up': OP_UP}
+BUTTON_NAMES = ('left', 'right', 'middle')
+
+_INPUT_HEADER = struct.Struct('<BBH')
+INPUT_EVENT_DTYPE = np.dtype([
+	('op', 'u1'),
+	('button', 'u1'),
+	('reserved', '<u2'),
+	('dx', '<i4'),
+	('dy', '<i4'),
+])
+
+
+# 入力メッセージの受信から mouse 操作までの時間
+_DISPATCH_SECONDS = histogram("input_dispatch_seconds", "Input message receive to mouse dispatch latency")
+
+
+def decode_input(data):
+	"""バイナリ入力メッセージを INPUT_EVENT_DTYPE の配列にする（不正なら ValueError）"""
+	if len(data) < _INPUT_HEADER.size:
+		raise ValueError("input message too short")
+	version, _, count = _INPUT_HEADER.unpack_from(data)
+	if version != INPUT_PROTOCOL_VERSION:
+		raise ValueError(f"unsupported input protocol version: {version}")
+	if len(data) != _INPUT_HEADER.size + count * INPUT_EVENT_DTYPE.itemsize:
+		raise ValueError("input message length does not match event count")
+	return np.frombuffer(data, INPUT_EVENT_DTYPE, count, _INPUT_HEADER.size)
+
+
+def encode_input(events):
+	"""(op, button, dx, dy) の並びをバイナリ入力メッセージにする"""
+	arr = np.zeros(len(events), INPUT_EVENT_DTYPE)
+	for i, (op, button, dx, dy) in enumerate(events):
+		arr[i] = (op, button, 0, round(dx * INPUT_FIXED_ONE), round(dy * INPUT_FIXED_ONE))
+	return _INPUT_HEADER.pack(INPUT_PROTOCOL_VERSION, 0, len(events)) + arr.tobytes()
+
+
+def _json_events(msg):
+	"""JSON 形式の入力メッセージ（dict）を (op, button, dx, dy) に変換する"""
+	if msg.get('input') == 'mouse':
+		# 相対移動のみサポート（dx/dy は正規化）
+		if 'dx' in msg or 'dy' in msg:
+			yield OP_MOVE, None, float(msg.get('dx', 0)), float(msg.get('dy', 0))
+		op = _ACTION_OPS.get(msg.get('action'))
+		if op is not None:
+			yield op, msg.get('button', 'left'), 0.0, 0.0
+	elif msg.get('input') == 'wheel':
+		yield OP_WHEEL, None, float(msg.get('deltaX', 0)), float(msg.get('deltaY', 0))
+
+
+def _binary_events(events):
+	"""decode_input の結果を (op, button, dx, dy) に変換する"""
+	scale = 1.0 / INPUT_FIXED_ONE
+	dxs = (events['dx'] * scale).tolist()
+	dys = (events['dy'] * scale).tolist()
+	for op, button, dx, dy in zip(events['op'].tolist(), events['button'].tolist(), dxs, dys):
+		name = BUTTON_NAMES[button] if button < len(BUTTON_NAMES) else 'left'
+		yield op, name, dx, dy
+
+
+def _button(name):
+	from pynput.mouse import Button
+	if name == 'middle':
+		return Button.middle
+	return Button.left if name == 'left' else Button.right
+
+
+class InputWorker:
+	"""1 セッション分の入力メッセージを順番通りに処理する専用スレッド。
+
+	メッセージは受信順にキューへ積み、ワーカーが 1 つずつ処理するため、
+	down より先に up が実行されるような入れ替わりは起きない。キューに溜まって
+	いる連続した相対移動は合算し、1 回の mouse.move にまとめる。ボタン操作の
+	直前には、それまでに溜まった移動を必ず反映する。
+
+	ホイールはピクセル単位のスクロール量を溜め、wheel_step ピクセルごとに
+	1 ステップとして mouse.scroll する。scroll の呼び出しは wheel_rate 回/秒
+	までに抑え、その間に溜まったステップは次の呼び出しでまとめて送る。
+
+	region は相対移動の基準にする範囲（dict）を返す関数。None を返す間は
+	画面サイズ（最初に 1 度だけ取得してキャッシュ）を使う。
+
+	mouse は pynput の Controller を返す関数で、最初の入力の処理で呼ぶ
+	（X ディスプレイの無い環境でも、入力を受けるまではワーカーを作れる）。
+	"""
+
+	def __init__(self, mouse, cursor=None, move_scale=1.7, region=None, wheel_step=100, wheel_rate=30):
+		self._mouse_factory = mouse
+		self._mouse = None
+		self.cursor = cursor
+		self.move_scale = move_scale
+		self.region = region
+		self.wheel_step = wheel_step
+		self.wheel_interval = 1.0 / wheel_rate
+		# ボタンが押されたままか追跡（ボタン名 → 押した時刻）
+		self.pressed_buttons = {}
+		# 合算した移動イベント数・実際に行った move 回数
+		self.events = 0
+		self.moves = 0
+		self.scrolls = 0
+		self._queue = queue.Queue()
+		self._screen = None
+		# 整数ピクセルに丸めた残り（小さな移動が切り捨てで消えないよう持ち越す）
+		self._rem_x = 0.0
+		self._rem_y = 0.0
+		# まだ送っていないスクロール量（ピクセル）と最後に scroll した時刻
+		self._wheel_x = 0.0
+		self._wheel_y = 0.0
+		self._last_scroll = 0.0
+		self._thread = threading.Thread(target=self._run, name="InputWorker", daemon=True)
+
+	@property
+	def mouse(self):
+		if self._mouse is None:
+			self._mouse = self._mouse_factory()
+		return self._mouse
+
+	def start(self):
+		self._thread.start()
+
+	def stop(self):
+		self._queue.put(None)
+
+	def submit(self, msg):
+		"""入力メッセージを受信順にキューへ積む（JSON の dict か decode_input の結果）"""
+		self._queue.put((time.perf_counter(), msg))
+
+	def release_stuck(self, max_age):
+		"""max_age 秒以上押されたままのボタンを離すよう要求する"""
+		now = time.time()
+		for name, ts in list(self.pressed_buttons.items()):
+			if now - ts > max_age:
+				print(f"Releasing stuck button: {name}")
+				self.submit({'input': 'mouse', 'action': 'up', 'button': name})
+
+	def _screen_size(self):
+		region = self.region() if self.region is not None else None
+		if region is not None:
+			return region['width'], region['height']
+		if self._screen is None:
+			# 画面サイズ（Windows）取得
+			try:
+				self._screen = (
+					ctypes.windll.user32.GetSystemMetrics(0),
+					ctypes.windll.user32.GetSystemMetrics(1)
+				)
+			except Exception:
+				# フォールバック: 1920x1080
+				self._screen = (1920, 1080)
+		return self._screen
+
+	def _run(self):
+		while True:
+			# 送れずに溜まっているスクロールがあれば、送れる時刻まで待つ
+			try:
+				item = self._queue.get(timeout=self._scroll_timeout())
+			except queue.Empty:
+				self._scroll()
+				continue
+			if item is None:
+				return
+			dx = dy = 0.0
+			# まだ反映していないメッセージの受信時刻
+			pending = []
+			# キューに溜まっている分をまとめて処理する
+			while item is not None:
+				received, msg = item
+				pending.append(received)
+				try:
+					events = _json_events(msg) if isinstance(msg, dict) else _binary_events(msg)
+					for op, button, ex, ey in events:
+						if op == OP_MOVE:
+							dx += ex
+							dy += ey
+							self.events += 1
+						elif op == OP_WHEEL:
+							self._add_wheel(ex, ey)
+						elif op in (OP_CLICK, OP_DOWN, OP_UP):
+							self._move(dx, dy)
+							dx = dy = 0.0
+							self._scroll(force=True)
+							self._press(op, button)
+							self._observe(pending)
+				except Exception as e:
+					print('handle_input error', e)
+				try:
+					item = self._queue.get_nowait()
+				except queue.Empty:
+					break
+				if item is None:
+					self._move(dx, dy)
+					return
+			self._move(dx, dy)
+			self._scroll()
+			self._observe(pending)
+
+	def _observe(self, pending):
+		now = time.perf_counter()
+		for received in pending:
+			_DISPATCH_SECONDS.observe(now - received)
+		pending.clear()
+
+	def _add_wheel(self, dx, dy):
+		# 向きが変わったら前の向きの端数は捨てる
+		if dx * self._wheel_x < 0:
+			self._wheel_x = 0.0
+		if dy * self._wheel_y < 0:
+			self._wheel_y = 0.0
+		self._wheel_x += dx
+		self._wheel_y += dy
+
+	def _scroll_timeout(self):
+		"""溜まったスクロールを送れるまでの秒数（送るステップが無ければ None）"""
+		if abs(self._wheel_x) < self.wheel_step and abs(self._wheel_y) < self.wheel_step:
+			return None
+		return max(self._last_scroll + self.wheel_interval - time.monotonic(), 0.0)
+
+	def _scroll(self, force=False):
+		"""溜まったスクロール量のうち整数ステップ分を送る（force でなければ頻度を制限）"""
+		timeout = self._scroll_timeout()
+		if timeout is None or (timeout > 0 and not force):
+			return
+		steps_x = int(self._wheel_x / self.wheel_step)
+		steps_y = int(self._wheel_y / self.wheel_step)
+		self._wheel_x -= steps_x * self.wheel_step
+		self._wheel_y -= steps_y * self.wheel_step
+		try:
+			# ブラウザの deltaY は下向きが正、pynput の scroll は上向きが正
+			self.mouse.scroll(steps_x, -steps_y)
+		except Exception as e:
+			print('scroll error', e)
+		self._last_scroll = time.monotonic()
+		self.scrolls += 1
+
+	def _move(self, dx_norm, dy_norm):
+		if dx_norm == 0 and dy_norm == 0:
+			return
+		screen_w, screen_h = self._screen_size()
+		# 画面幅/高さに基づくピクセル量にスケールを適用
+		fx = dx_norm * screen_w * self.move_scale + self._rem_x
+		fy = dy_norm * screen_h * self.move_scale + self._rem_y
+		dx_px = int(fx)
+		dy_px = int(fy)
+		self._rem_x = fx - dx_px
+		self._rem_y = fy - dy_px
+		if dx_px == 0 and dy_px == 0:
+			return
+		try:
+			self.mouse.move(dx_px, dy_px)
+		except Exception:
+			# フォールバック: 現在位置へオフセット移動
+			try:
+				cx, cy = self.mouse.position
+				self.mouse.position = (int(cx + dx_px), int(cy + dy_px))
+			except Exception:
+				pass
+		self.moves += 1
+		# 合成用カーソル位置を更新（画面端での補正後の位置を読む）
+		if self.cursor is not None:
+			try:
+				self.cursor.update(self.mouse.position)
+			except Exception:
+				pass
+
+	def _press(self, op, button_name):
+		button = _button(button_name)
+		if op == OP_CLICK:
+			try:
+				self.mouse.click(button)
+			except Exception as e:
+				print('click error', e)
+		elif op == OP_DOWN:
+			self.mouse.press(button)
+			self.pressed_buttons[button_name] = time.time()
+		elif op == OP_UP:
+			try:
+				self.mouse.release(button)
+			except Exception as e:
+				print('release error', e)
+			self.pressed_buttons.pop(button_name, None)
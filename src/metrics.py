@@ -0,0 +1,195 @@
+import asyncio
+import bisect
+import json
+import threading
+import time
+
+
+# 遅延ヒストグラムのバケット上限（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+class Histogram:
+	"""Prometheus 形式で出力できる累積ヒストグラム（どのスレッドからでも observe できる）"""
+
+	def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+		self.name = name
+		self.help = help
+		self.buckets = tuple(buckets)
+		# 最後の要素は +Inf バケット
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+		self.max = 0.0
+		self._lock = threading.Lock()
+
+	def observe(self, value):
+		i = bisect.bisect_left(self.buckets, value)
+		with self._lock:
+			self.counts[i] += 1
+			self.sum += value
+			self.count += 1
+			if value > self.max:
+				self.max = value
+
+	def quantile(self, q):
+		"""q 分位点が入るバケットの上限（最後のバケットなら最大値、データが無ければ None）"""
+		with self._lock:
+			counts = list(self.counts)
+			total = self.count
+		if total == 0:
+			return None
+		rank = q * total
+		seen = 0
+		for i, c in enumerate(counts):
+			seen += c
+			if seen >= rank:
+				return self.buckets[i] if i < len(self.buckets) else self.max
+		return self.max
+
+	def snapshot(self):
+		"""JSON ログ用の要約（件数・合計・平均・最大・p50/p95/p99 の秒数）"""
+		with self._lock:
+			count = self.count
+			total = self.sum
+		return {
+			"count": count,
+			"sum": total,
+			"avg": total / count if count else None,
+			"max": self.max,
+			"p50": self.quantile(0.5),
+			"p95": self.quantile(0.95),
+			"p99": self.quantile(0.99),
+		}
+
+	def render(self):
+		with self._lock:
+			counts = list(self.counts)
+			total = self.sum
+			count = self.count
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+		cumulative = 0
+		for bound, c in zip(self.buckets, counts):
+			cumulative += c
+			lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+		lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+		lines.append(f"{self.name}_sum {total}")
+		lines.append(f"{self.name}_count {count}")
+		return lines
+
+
+class Gauge:
+	"""ラベルごとに最新値を持つゲージ"""
+
+	def __init__(self, name, help):
+		self.name = name
+		self.help = help
+		self.values = {}
+
+	def set(self, labels, value):
+		"""labels は (名前, 値) のタプルの並び"""
+		self.values[tuple(labels)] = value
+
+	def remove(self, labels):
+		self.values.pop(tuple(labels), None)
+
+	def snapshot(self):
+		return {",".join(f"{k}={v}" for k, v in labels): value for labels, value in list(self.values.items())}
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+		for labels, value in list(self.values.items()):
+			label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+			lines.append(f"{self.name}{{{label_text}}} {value}" if label_text else f"{self.name} {value}")
+		return lines
+
+
+# 名前 → Histogram / Gauge
+_metrics = {}
+
+
+def histogram(name, help, buckets=DEFAULT_BUCKETS):
+	"""名前に対応する Histogram を返す（無ければ作成）"""
+	metric = _metrics.get(name)
+	if metric is None:
+		metric = _metrics[name] = Histogram(name, help, buckets)
+	return metric
+
+
+def gauge(name, help):
+	"""名前に対応する Gauge を返す（無ければ作成）"""
+	metric = _metrics.get(name)
+	if metric is None:
+		metric = _metrics[name] = Gauge(name, help)
+	return metric
+
+
+def render_prometheus():
+	"""登録済みの全メトリクスを Prometheus のテキスト形式にする"""
+	lines = []
+	for metric in list(_metrics.values()):
+		lines.extend(metric.render())
+	return "\n".join(lines) + "\n"
+
+
+def snapshot():
+	"""登録済みの全メトリクスの要約（JSON にできる dict）"""
+	return {name: metric.snapshot() for name, metric in list(_metrics.items())}
+
+
+async def _handle_http(reader, writer):
+	try:
+		request_line = await reader.readline()
+		# ヘッダは読み捨てる
+		while True:
+			line = await reader.readline()
+			if not line or line in (b"\r\n", b"\n"):
+				break
+		parts = request_line.decode("latin-1").split()
+		if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+			body = render_prometheus().encode()
+			status = "200 OK"
+			content_type = "text/plain; version=0.0.4; charset=utf-8"
+		else:
+			body = b"not found\n"
+			status = "404 Not Found"
+			content_type = "text/plain; charset=utf-8"
+		writer.write(
+			f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+			f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+		)
+		await writer.drain()
+	except Exception as e:
+		print("Metrics request error:", e)
+	finally:
+		writer.close()
+
+
+async def start_metrics_server(port, host="127.0.0.1"):
+	"""GET /metrics に Prometheus 形式で応答する HTTP サーバーを開始する"""
+	server = await asyncio.start_server(_handle_http, host, port)
+	print(f"Metrics endpoint: http://{host}:{port}/metrics")
+	return server
+
+
+async def log_metrics(interval):
+	"""interval 秒ごとに全メトリクスの要約を JSON 1 行で出力する"""
+	while True:
+		await asyncio.sleep(interval)
+		print("metrics", json.dumps({"time": time.time(), **snapshot()}))
+
+
+async def publish_stats(port, interval=0.5, host="127.0.0.1"):
+	"""interval 秒ごとに全メトリクスの要約を JSON の UDP データグラムで host:port へ送る。
+
+	設定 GUI のダッシュボードが受け取って表示する。受け手が居なくても送信側は止まらない。
+	区間ごとの平均は、受け手が前回との count・sum の差から求める。
+	"""
+	loop = asyncio.get_event_loop()
+	transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+	try:
+		while True:
+			await asyncio.sleep(interval)
+			transport.sendto(json.dumps({"time": time.time(), **snapshot()}).encode())
+	finally:
+		transport.close()
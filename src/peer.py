@@ -0,0 +1,1006 @@
+import asyncio
+import json
+from collections import deque
+import aiortc
+from aiortc import RTCPeerConnection, RTCRtpSender, RTCSessionDescription, VideoStreamTrack, AudioStreamTrack, RTCIceCandidate
+from aiortc.mediastreams import MediaStreamError, VIDEO_CLOCK_RATE, VIDEO_TIME_BASE
+import numpy as np
+import os
+import fractions
+import secrets
+import time
+from urllib.parse import parse_qs, urlparse
+from adaptive import AdaptiveController
+from audio import SilenceGate, audio_captures, discard_audio_capture, get_audio_capture
+from broadcast import BroadcastTrack, VideoBroadcaster
+from capture import discard_screen_capture, get_screen_capture, monitor_count, screen_captures
+from cursor import CursorState, windows_cursor_shape
+from input_handler import InputWorker, decode_input
+from metrics import gauge, histogram
+from recorder import SessionRecorder
+import settings
+from settings import METRICS_ENABLED, SENDER_STATS_INTERVAL
+from synthetic import ReplayScreen, SyntheticAudioStream, SyntheticScreen
+
+# キーフレーム要求の差し替えに RTCRtpSender の非公開メソッドを使う（requirements.txt で固定した aiortc 1.15 系にあるもの）
+if not hasattr(RTCRtpSender, "_send_keyframe"):
+	raise RuntimeError(
+		f"RTCRtpSender._send_keyframe is missing in aiortc {aiortc.__version__}; install aiortc 1.15.x (requirements.txt)"
+	)
+
+_mouse = None
+
+def _get_mouse():
+	"""入力に使う pynput の Controller（X ディスプレイの無い環境でも peer を読み込めるよう、最初に使うときに作る）"""
+	global _mouse
+	if _mouse is None:
+		from pynput.mouse import Controller
+		_mouse = Controller()
+	return _mouse
+
+# 映像に合成するカーソル位置（入力処理が更新し、キャプチャは読むだけ。位置を読めない環境では描かない）
+_cursor = CursorState(
+	source=lambda: _get_mouse().position,
+	shape_source=windows_cursor_shape if os.name == 'nt' else None
+)
+# カーソル描画のスケール
+CURSOR_SCALE = 3.0
+# マウス移動のスピードスケール
+MOUSE_MOVE_SCALE = 1.7
+
+# 段階ごとの処理時間
+_PACING_SECONDS = histogram("video_pacing_wait_seconds", "ScreenTrack.recv pacing and idle wait time")
+_FRAME_BUILD_SECONDS = histogram("video_frame_build_seconds", "VideoFrame build time")
+_FRAME_AGE_SECONDS = histogram("video_frame_age_seconds", "Capture to VideoFrame handoff age")
+_ENCODE_SEND_SECONDS = histogram("video_encode_send_seconds", "Time from handing a frame to the sender until it asks for the next (encode, packetize, send)")
+_AUDIO_QUEUE_SECONDS = histogram("audio_queue_delay_seconds", "Audio callback to recv queue delay")
+_AUDIO_BUFFER_DEPTH = gauge("audio_buffer_depth_samples", "Samples waiting in the audio ring buffer for this track")
+_AUDIO_UNDERRUNS = gauge("audio_underruns", "Audio reads that waited more than 1.5 blocks for data (capture gaps)")
+_AUDIO_OVERRUNS = gauge("audio_overruns", "Times unread audio was overwritten because the reader fell behind")
+_AUDIO_DROPPED_SAMPLES = gauge("audio_dropped_samples", "Audio samples skipped to keep latency near the target")
+_ACHIEVED_FPS = gauge("video_achieved_fps", "Frames per second actually delivered to the encoder")
+_TARGET_FPS = gauge("video_target_fps", "Configured SCREEN_FPS")
+_SKIPPED_FRAMES = gauge("video_skipped_frames", "Frames skipped because capture or encode fell behind")
+_VIDEO_LEVEL = gauge("video_adaptive_level", "Current step on ADAPTIVE_LADDER (0 is full quality)")
+_SEND_BITRATE = gauge("webrtc_send_bitrate_bps", "Outbound RTP bitrate")
+_RTT_SECONDS = gauge("webrtc_rtt_seconds", "Round trip time reported by the receiver")
+_FRACTION_LOST = gauge("webrtc_fraction_lost", "Fraction of packets lost reported by the receiver (0-1)")
+# 接続から最初の映像フレームをエンコーダーへ渡すまでの時間（cold: キャプチャを開いた / warm: 動作中のキャプチャを使った / resume: セッション再開）
+_TTFF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+_TTFF_SECONDS = {
+	kind: histogram(f"video_time_to_first_frame_{kind}_seconds", f"WebSocket connect to first video frame ({kind})", _TTFF_BUCKETS)
+	for kind in ("cold", "warm", "resume")
+}
+
+def _screen_backend(monitor_index):
+	"""CAPTURE_BACKEND に対応するキャプチャ元を開く関数（mss なら None）"""
+	if settings.CAPTURE_BACKEND == "synthetic":
+		return lambda: SyntheticScreen(monitor_count=max(monitor_index, 1))
+	if settings.CAPTURE_BACKEND == "replay":
+		return lambda: ReplayScreen(settings.CAPTURE_REPLAY_PATH, monitor_count=max(monitor_index, 1))
+	return None
+
+def _audio_stream_factory():
+	"""AUDIO_BACKEND に対応する入力ストリームを作る関数（sounddevice なら None）"""
+	if settings.AUDIO_BACKEND == "synthetic":
+		return SyntheticAudioStream
+	return None
+
+def _screen_capture(monitor_index):
+	"""現在の設定で monitor_index の共有 ScreenCapture を返す（無ければ作成）"""
+	return get_screen_capture(
+		monitor_index, settings.SCREEN_FPS,
+		cursor=_cursor,
+		cursor_scale=CURSOR_SCALE,
+		mode=settings.CAPTURE_MODE,
+		idle_delay=settings.SCREEN_IDLE_DELAY,
+		region=settings.CAPTURE_REGION,
+		output_size=settings.CAPTURE_OUTPUT_SIZE,
+		backend=_screen_backend(monitor_index),
+		scene_cut_threshold=settings.SCENE_CUT_THRESHOLD,
+		linger=settings.SESSION_RESUME_SECONDS
+	)
+
+def _audio_capture(samplerate, channels, device_id=None, max_latency_ms=None):
+	"""現在の設定で共有 AudioCapture を返す（無ければ作成）"""
+	return get_audio_capture(
+		samplerate, channels,
+		device_id=device_id,
+		max_latency_ms=settings.AUDIO_MAX_LATENCY_MS if max_latency_ms is None else max_latency_ms,
+		stream_factory=_audio_stream_factory(),
+		linger=settings.SESSION_RESUME_SECONDS
+	)
+
+def _layout(channels):
+	return 'mono' if channels == 1 else 'stereo'
+
+# 動作中のトラック（設定の変更を反映する対象）
+_screen_tracks = set()
+_audio_tracks = set()
+
+class SystemAudioTrack(AudioStreamTrack):
+	kind = "audio"
+
+	def __init__(self, samplerate=None, channels=None, device_id=None,
+			target_latency_ms=None, max_latency_ms=None):
+		super().__init__()
+		# 送信する音声の形式。Opus エンコーダーは最初のフレームの形式に固定されるため、
+		# 設定の変更でキャプチャの形式が変わってもトラックの出力は変えない（変換して送る）
+		self.samplerate = samplerate or settings.AUDIO_SAMPLE_RATE
+		self.channels = channels or settings.AUDIO_CHANNELS
+		self.device_id = device_id
+		self.target_latency_ms = settings.AUDIO_TARGET_LATENCY_MS if target_latency_ms is None else target_latency_ms
+		self.blocksize = int(self.samplerate * 0.02)
+		self._block = np.zeros((self.blocksize, self.channels), np.int16)
+		self._silent_block = np.zeros_like(self._block)
+		self.reader = None
+		# 同じデバイスのキャプチャは全ピアで共有し、読み出し位置だけをピアごとに持つ
+		self._bind(_audio_capture(self.samplerate, self.channels, device_id, max_latency_ms))
+		self._pts = 0
+		self._last_sent_pts = None
+		self.skipped_blocks = 0
+		self._stats_published = 0.0
+		self.reconfigure()
+		_audio_tracks.add(self)
+
+	def _bind(self, capture):
+		self.capture = capture
+		# キャプチャの形式が送信の形式と違えば 20ms ずつのフレームに変換する
+		if (capture.samplerate, capture.channels) == (self.samplerate, self.channels):
+			self._resampler = None
+			self._source_block = self._block
+		else:
+			from av import AudioResampler
+			self._resampler = AudioResampler(
+				format='s16',
+				layout=_layout(self.channels),
+				rate=self.samplerate,
+				frame_size=self.blocksize
+			)
+			self._source_block = np.zeros((capture.blocksize, capture.channels), np.int16)
+		self._converted = deque()
+
+	def reconfigure(self):
+		"""遅延の目標と無音の間引き（DTX）を現在の設定で作り直す"""
+		if self.reader is not None and self.target_latency_ms != settings.AUDIO_TARGET_LATENCY_MS:
+			self.reader.target = min(int(self.capture.samplerate * settings.AUDIO_TARGET_LATENCY_MS / 1000), self.capture.buffer.capacity)
+		self.target_latency_ms = settings.AUDIO_TARGET_LATENCY_MS
+		# 無音区間は dtx_interval ごとにしか送らない（pts は読み飛ばした分も進める）
+		self.gate = SilenceGate(
+			open_db=settings.AUDIO_SILENCE_THRESHOLD_DB,
+			close_db=settings.AUDIO_SILENCE_THRESHOLD_DB - 6,
+			hang_blocks=max(int(settings.AUDIO_SILENCE_HANG_MS / 20), 1)
+		) if settings.AUDIO_DTX else None
+		self.dtx_interval = int(self.samplerate * settings.AUDIO_DTX_INTERVAL_MS / 1000)
+
+	def switch_capture(self, capture):
+		"""共有キャプチャを capture に切り替える（サンプルレートやデバイスの変更時。再ネゴシエーションは不要）"""
+		previous = self.capture
+		if capture is previous:
+			return
+		recording = self.reader is not None
+		if recording:
+			# 同じデバイスを 2 つ開かないよう、先に前のキャプチャを手放す
+			# （そのデータを待っている recv は停止で起き、新しいキャプチャから読み直す）
+			previous.unsubscribe()
+			capture.subscribe()
+		self._bind(capture)
+		if recording:
+			self.reader = capture.buffer.reader(int(capture.samplerate * self.target_latency_ms / 1000))
+
+	def start_recording(self):
+		if self.reader is None:
+			self.capture.subscribe()
+			self.reader = self.capture.buffer.reader(int(self.capture.samplerate * self.target_latency_ms / 1000))
+
+	def stop_recording(self):
+		if self.reader is not None:
+			self.reader = None
+			self.capture.unsubscribe()
+
+	async def _read_block(self):
+		"""次の 20ms 分（送信の形式）を返す。読んでいる途中でキャプチャが切り替わったら None"""
+		capture, reader = self.capture, self.reader
+		if self._resampler is None:
+			filled = await capture.read(reader, self._block)
+			if capture is not self.capture:
+				return None
+			return self._block if filled else await self._silence()
+		from av import AudioFrame
+		while not self._converted:
+			source = self._source_block
+			filled = await capture.read(reader, source)
+			if capture is not self.capture:
+				return None
+			if not filled:
+				return await self._silence()
+			frame = AudioFrame.from_ndarray(source.reshape(1, -1), format='s16', layout=_layout(capture.channels))
+			frame.sample_rate = capture.samplerate
+			for converted in self._resampler.resample(frame):
+				self._converted.append(converted.to_ndarray().reshape(-1, self.channels))
+		return self._converted.popleft()
+
+	async def _silence(self):
+		"""キャプチャが動いていない（デバイスを開けなかった）間は、実時間のペースで無音を返す"""
+		await asyncio.sleep(self.blocksize / self.samplerate)
+		return self._silent_block
+
+	async def recv(self):
+		from av import AudioFrame
+		while True:
+			if self.reader is None:
+				raise MediaStreamError
+			# 次のブロックが溜まるまで待つ
+			data = await self._read_block()
+			if data is None:
+				continue
+			# データ形状: (samples, channels)
+			samples = data.shape[0]
+			# 読んだブロックの先頭がコールバックで書かれてから経った時間
+			_AUDIO_QUEUE_SECONDS.observe(self.reader.depth / self.capture.samplerate + samples / self.samplerate)
+			self._publish_stats()
+			pts = self._pts
+			self._pts += samples
+			if self.gate is None or self.gate.update(data):
+				break
+			# 無音中は間引き、一定間隔で keep-alive のフレームだけ送る
+			if self._last_sent_pts is None or pts - self._last_sent_pts >= self.dtx_interval:
+				break
+			self.skipped_blocks += 1
+		self._last_sent_pts = pts
+		frame = AudioFrame(format='s16', layout=_layout(self.channels), samples=samples)
+		frame.planes[0].update(data)
+		frame.sample_rate = self.samplerate
+
+		# サンプル数に基づいて pts/time_base を設定
+		frame.pts = pts
+		frame.time_base = fractions.Fraction(1, self.samplerate)
+		return frame
+
+	def _publish_stats(self):
+		"""リングバッファの読み出し状況（AudioReader.stats()）を 1 秒ごとにメトリクスへ出す"""
+		now = time.monotonic()
+		if now - self._stats_published < 1.0:
+			return
+		self._stats_published = now
+		labels = (("track", self.id),)
+		stats = self.reader.stats()
+		_AUDIO_BUFFER_DEPTH.set(labels, stats["depth"])
+		_AUDIO_UNDERRUNS.set(labels, stats["underruns"])
+		_AUDIO_OVERRUNS.set(labels, stats["overruns"])
+		_AUDIO_DROPPED_SAMPLES.set(labels, stats["dropped"])
+
+	def stop(self):
+		# RTCRtpSender.stop() からも同期で呼ばれる（2 回目以降は何もしない）
+		super().stop()
+		if self not in _audio_tracks:
+			return
+		_audio_tracks.discard(self)
+		self.stop_recording()
+		labels = (("track", self.id),)
+		for metric in (_AUDIO_BUFFER_DEPTH, _AUDIO_UNDERRUNS, _AUDIO_OVERRUNS, _AUDIO_DROPPED_SAMPLES):
+			metric.remove(labels)
+		print("Audio track stopped.")
+
+# 画面キャプチャ用VideoStreamTrack
+class ScreenTrack(VideoStreamTrack):
+	def __init__(self, fps=None, monitor_index=None, idle_fps=None):
+		super().__init__()
+		# 同じモニターのキャプチャは全ピアで共有する
+		self.capture = _screen_capture(settings.SCREEN_MONITOR_INDEX if monitor_index is None else monitor_index)
+		# キャプチャを開くところから始めたか（最初のフレームまでの時間の分類に使う）
+		self.cold_start = not self.capture.running
+		self.capture.subscribe()
+		# 設定のフレームレートと、回線状況に合わせた出力解像度・フレームレートの上限
+		self.base_fps = fps or settings.SCREEN_FPS
+		self._size = None
+		self._quality_fps = None
+		self._update_fps()
+		self.idle_frame_time = 1.0 / (idle_fps or settings.SCREEN_IDLE_FPS)
+		# 次のフレームを送る予定時刻（loop.time()）。前回の送信時刻ではなく予定時刻から
+		# frame_time ずつ進めるため、処理時間の分だけ周期が伸びることはない
+		self._deadline = None
+		self._last_sent = 0.0
+		# pts の基準（最初に送ったフレームのキャプチャ時刻）と直前の pts・フレーム番号
+		self._start = None
+		self._last_pts = None
+		self._last_seq = None
+		# 遅れのため送らなかったフレーム数
+		self.skipped_frames = 0
+		# 場面転換時にキーフレームを要求する関数（offer() で送信側の RTCRtpSender に結びつける）
+		self.request_keyframe = None
+		self.burst_time = settings.SCENE_CUT_BURST_MS / 1000
+		self._scene_cuts = self.capture.scene_cuts
+		self._burst_until = 0.0
+		# 最初のフレームを渡したときに呼ぶ関数（接続からの時間の計測用）
+		self.on_first_frame = None
+		# 直前にフレームを渡した時刻（次の recv までの時間 = 送信側のエンコードと送信の時間）
+		self._handed_off = None
+		# 実効フレームレート（約 1 秒ごとに更新）
+		self.achieved_fps = 0.0
+		self._fps_frames = 0
+		self._fps_started = None
+		# 直近に送ったフレームのキャプチャ情報（変化領域などのメタデータ）
+		self.last_capture = None
+		self._subscribed = True
+		_screen_tracks.add(self)
+
+	def _timestamp(self, captured):
+		# pts は送信時刻ではなくキャプチャ時刻から求める（静止中の送り直しは送信時刻）
+		if self._start is None:
+			self._start = captured.time
+		t = captured.time if captured.seq != self._last_seq else time.monotonic()
+		pts = int((t - self._start) * VIDEO_CLOCK_RATE)
+		if self._last_pts is not None and pts <= self._last_pts:
+			pts = self._last_pts + 1
+		self._last_pts = pts
+		self._last_seq = captured.seq
+		return pts, VIDEO_TIME_BASE
+
+	async def _pace(self):
+		"""予定時刻まで待つ。1 フレーム以上遅れていたら、その分のフレームは飛ばす"""
+		loop = asyncio.get_event_loop()
+		now = loop.time()
+		if self._deadline is None:
+			self._deadline = now
+			# 送り始めはエンコーダーが画質を上げられるよう、静止していてもフルレートで送る
+			self._burst_until = now + self.burst_time
+		wait = self._deadline - now
+		if wait > 0:
+			await asyncio.sleep(wait)
+		elif -wait >= self.frame_time:
+			# キャプチャやエンコードが遅れた。遅れを取り戻そうと詰めて送らず、次の予定時刻に合わせる
+			missed = int(-wait / self.frame_time)
+			self.skipped_frames += missed
+			self._deadline += missed * self.frame_time
+		# 画面が静止している間は、変化か入力が来るまで keep-alive 間隔で待つ
+		# （場面転換の直後はエンコーダーが新しい画面を詰められるようフルレートを保つ）
+		if self.capture.idle and loop.time() >= self._burst_until:
+			timeout = self._last_sent + self.idle_frame_time - loop.time()
+			if timeout > 0:
+				await self.capture.wait_change(timeout)
+			# 静止からの復帰は復帰した時刻を基準に予定を組み直す
+			self._deadline = max(self._deadline, loop.time())
+		self._last_sent = loop.time()
+		self._deadline += self.frame_time
+
+	def set_quality(self, size, fps=None):
+		"""出力解像度の上限 (w, h) とフレームレートの上限を変更する（None で通常の設定）"""
+		self._size = size
+		self._quality_fps = fps
+		self._update_fps()
+		self.capture.request_output_size(self, size)
+
+	def set_fps(self, fps):
+		"""設定のフレームレートを変更する（回線状況による上限はそのまま）"""
+		self.base_fps = fps
+		self._update_fps()
+
+	def _update_fps(self):
+		self.fps = min(self._quality_fps, self.base_fps) if self._quality_fps else self.base_fps
+		self.frame_time = 1.0 / self.fps
+
+	def switch_capture(self, capture):
+		"""共有キャプチャを capture に切り替える（モニターや取得範囲の変更時。再ネゴシエーションは不要）"""
+		previous = self.capture
+		if capture is previous:
+			return
+		# 先に前のキャプチャを手放してから新しいキャプチャを購読する
+		previous.request_output_size(self, None)
+		previous.unsubscribe()
+		capture.subscribe()
+		capture.request_output_size(self, self._size)
+		self.capture = capture
+		self._scene_cuts = capture.scene_cuts
+		self._last_seq = None
+		# 新しい画面はキーフレームから送る
+		if self.request_keyframe is not None:
+			self.request_keyframe()
+
+	def _count_frame(self):
+		now = time.monotonic()
+		if self._fps_started is None:
+			self._fps_started = now
+		self._fps_frames += 1
+		elapsed = now - self._fps_started
+		if elapsed >= 1.0:
+			self.achieved_fps = self._fps_frames / elapsed
+			self._fps_frames = 0
+			self._fps_started = now
+			labels = (("track", self.id),)
+			_ACHIEVED_FPS.set(labels, round(self.achieved_fps, 2))
+			_TARGET_FPS.set(labels, self.fps)
+			_SKIPPED_FRAMES.set(labels, self.skipped_frames)
+
+	async def recv(self):
+		from av import VideoFrame
+		if self.readyState != "live":
+			raise MediaStreamError
+		started = time.perf_counter()
+		if self._handed_off is not None:
+			_ENCODE_SEND_SECONDS.observe(started - self._handed_off)
+		# フレームレート制御
+		await self._pace()
+		# 共有キャプチャの最新フレームを参照（コピーしない）
+		while True:
+			capture = self.capture
+			try:
+				captured = await capture.latest()
+				break
+			except MediaStreamError:
+				# 待っている間に別のキャプチャへ切り替わったら、そちらで待ち直す
+				if capture is self.capture:
+					raise
+		self.last_capture = captured
+		# 前回の送信以降に場面転換があれば、このフレームをキーフレームにする
+		if self.capture.scene_cuts != self._scene_cuts:
+			self._scene_cuts = self.capture.scene_cuts
+			self._burst_until = asyncio.get_event_loop().time() + self.burst_time
+			if self.request_keyframe is not None:
+				self.request_keyframe()
+		build_start = time.perf_counter()
+		_PACING_SECONDS.observe(build_start - started)
+		# プールのバッファをコピーせずに包む（エンコーダーは yuv420p をそのまま使う）
+		video_frame = VideoFrame.from_numpy_buffer(captured.image, format="yuv420p")
+		video_frame.pts, video_frame.time_base = self._timestamp(captured)
+		_FRAME_BUILD_SECONDS.observe(time.perf_counter() - build_start)
+		_FRAME_AGE_SECONDS.observe(time.monotonic() - captured.time)
+		self._count_frame()
+		if self.on_first_frame is not None:
+			callback, self.on_first_frame = self.on_first_frame, None
+			callback()
+		self._handed_off = time.perf_counter()
+		return video_frame
+
+	def stop(self):
+		super().stop()
+		if self._subscribed:
+			self._subscribed = False
+			_screen_tracks.discard(self)
+			self.capture.request_output_size(self, None)
+			self.capture.unsubscribe()
+			labels = (("track", self.id),)
+			_ACHIEVED_FPS.remove(labels)
+			_TARGET_FPS.remove(labels)
+			_SKIPPED_FRAMES.remove(labels)
+
+# 配信モードで全接続が共有するエンコーダー
+_broadcaster = None
+
+def _get_broadcaster():
+	global _broadcaster
+	if _broadcaster is None:
+		_broadcaster = VideoBroadcaster(
+			lambda: ScreenTrack(),
+			bitrate=settings.BROADCAST_BITRATE
+		)
+	return _broadcaster
+
+def _prefer_vp8(pc, sender):
+	"""sender の映像を VP8 で送るよう交渉する（配信モードのパケットは VP8 のため）"""
+	codecs = [
+		codec for codec in RTCRtpSender.getCapabilities("video").codecs
+		if codec.mimeType in ("video/VP8", "video/rtx")
+	]
+	for transceiver in pc.getTransceivers():
+		if transceiver.sender is sender:
+			transceiver.setCodecPreferences(codecs)
+
+def _record_path(template):
+	"""RECORD_PATH の {time} を接続時刻に置き換える（同じ名前のファイルがあれば番号を付ける）"""
+	path = template.replace("{time}", time.strftime("%Y%m%d-%H%M%S"))
+	base, ext = os.path.splitext(path)
+	number = 2
+	while os.path.exists(path):
+		path = f"{base}-{number}{ext}"
+		number += 1
+	return path
+
+def _record_first_frame(since, kind):
+	"""since（time.monotonic()）から最初の映像フレームを渡すまでの時間を kind として記録する"""
+	elapsed = time.monotonic() - since
+	_TTFF_SECONDS[kind].observe(elapsed)
+	print(f"First video frame after {elapsed * 1000:.0f} ms ({kind})")
+
+# シグナリングサーバー
+pcs = set()
+
+class Session:
+	"""再接続をまたいで引き継ぐ状態（入力ワーカーと回線適応の段階）。
+
+	WebSocket が閉じても SESSION_RESUME_SECONDS 秒は保持し、その間に
+	同じトークンで接続してきたクライアントはこのセッションを再開する。
+	"""
+
+	def __init__(self, input_worker, controller):
+		self.token = secrets.token_urlsafe(16)
+		self.input_worker = input_worker
+		self.controller = controller
+		# 現在このセッションを使っている WebSocket（切断中は None）
+		self.websocket = None
+		self._expire_handle = None
+
+	def attach(self, websocket):
+		"""websocket に結びつけ、それまで結びついていた WebSocket を返す"""
+		if self._expire_handle is not None:
+			self._expire_handle.cancel()
+			self._expire_handle = None
+		previous = self.websocket
+		self.websocket = websocket
+		return previous
+
+	def detach(self, websocket, timeout):
+		"""websocket の切断を反映し、timeout 秒後に破棄する（別の接続が再開済みなら何もしない）"""
+		if self.websocket is not websocket:
+			return
+		self.websocket = None
+		# 押したままのボタンは切断時点で離す
+		self.input_worker.release_stuck(0)
+		if timeout > 0:
+			self._expire_handle = asyncio.get_event_loop().call_later(timeout, self.expire)
+		else:
+			self.expire()
+
+	def expire(self):
+		self._expire_handle = None
+		sessions.pop(self.token, None)
+		self.input_worker.stop()
+		print("Session expired")
+
+# トークン → Session
+sessions = {}
+
+def _resume_session(path):
+	"""接続 URL の ?session=<トークン> に対応する保持中のセッションを返す（無ければ None）"""
+	token = parse_qs(urlparse(path or "").query).get("session", [None])[0]
+	return sessions.get(token) if token else None
+
+async def offer(websocket, path=None):
+	# websockets 13 以前は path を引数で渡し、それ以降は接続の request に持つ
+	if path is None:
+		path = websocket.request.path
+	# 途中で失敗しても、作れたものだけを finally で片付ける
+	pc = screen_track = audio_track = recorder = session = None
+	watchdog_task = stats_task = None
+	try:
+		connected = time.monotonic()
+		pc = RTCPeerConnection()
+		pcs.add(pc)
+		print("Created for", path)
+
+		# 画面キャプチャトラックを追加
+		if settings.BROADCAST_MODE:
+			screen_track = BroadcastTrack(_get_broadcaster())
+			video_sender = pc.addTrack(screen_track)
+			_prefer_vp8(pc, video_sender)
+			# 受信側の PLI/FIR は共有エンコーダーへのキーフレーム要求にする
+			video_sender._send_keyframe = screen_track.request_keyframe
+		else:
+			screen_track = ScreenTrack()
+			video_sender = pc.addTrack(screen_track)
+			# 場面転換でキーフレームを要求する（受信側の PLI と同じ経路）
+			screen_track.request_keyframe = video_sender._send_keyframe
+
+		# 音声キャプチャトラックを追加
+		audio_track = SystemAudioTrack()
+		audio_track.start_recording()  # クライアント接続時に録音開始
+		audio_sender = pc.addTrack(audio_track)
+
+		# 送信するエンコード済みパケットをそのままファイルへ書き出す（再エンコードしない）
+		if settings.RECORD_PATH:
+			recorder = SessionRecorder(_record_path(settings.RECORD_PATH))
+			recorder.tap(video_sender, request_keyframe=video_sender._send_keyframe)
+			recorder.tap(audio_sender)
+
+		# send server ICE candidates to client
+		@pc.on("icecandidate")
+		async def on_icecandidate(candidate):
+			if candidate:
+				try:
+					await websocket.send(json.dumps({"type": "candidate", "candidate": candidate}))
+				except Exception as e:
+					print("Failed to send candidate:", e)
+
+		# リモート記述が設定されるまで到着する candidate を一時バッファする
+		candidate_buffer = []
+
+		# 保持中のセッションがあれば再開し、無ければ新しく作る
+		session = _resume_session(path)
+		resumed = session is not None
+		if resumed:
+			previous = session.attach(websocket)
+			if previous is not None:
+				# 古い接続がまだ残っていれば閉じる（クリーンアップは古い接続のハンドラが行う）。
+				# 相手に届かない close の完了は待たない
+				asyncio.create_task(previous.close())
+			if session.controller is not None and session.controller.level > 0:
+				_apply_video_level(screen_track, session.controller)
+			print("Session resumed")
+		else:
+			# 入力はセッション専用のワーカーで受信順に処理する
+			input_worker = InputWorker(
+				_get_mouse,
+				cursor=_cursor,
+				move_scale=MOUSE_MOVE_SCALE,
+				# 設定でモニターや範囲が変わっても、その時点の共有キャプチャの範囲を使う
+				region=lambda: _screen_capture(settings.SCREEN_MONITOR_INDEX).region,
+				wheel_step=settings.WHEEL_PIXELS_PER_STEP,
+				wheel_rate=settings.WHEEL_MAX_RATE
+			)
+			input_worker.start()
+			controller = AdaptiveController([None] + settings.ADAPTIVE_LADDER) if settings.ADAPTIVE_VIDEO else None
+			session = Session(input_worker, controller)
+			session.attach(websocket)
+			sessions[session.token] = session
+		input_worker = session.input_worker
+		controller = session.controller
+		first_frame_kind = "resume" if resumed else "cold" if screen_track.cold_start else "warm"
+		screen_track.on_first_frame = lambda: _record_first_frame(connected, first_frame_kind)
+		# クライアントは切断後にこのトークンを付けて再接続する（ws://host:port/?session=<トークン>）
+		await websocket.send(json.dumps({"type": "session", "token": session.token, "resumed": resumed}))
+
+		async def _release_stuck_buttons():
+			while True:
+				input_worker.release_stuck(5.0)
+				await asyncio.sleep(1.0)
+
+		# この接続用の watchdog タスクを開始
+		watchdog_task = asyncio.create_task(_release_stuck_buttons())
+		# 送信統計の収集と、回線状況に合わせた解像度・フレームレートの調整
+		if METRICS_ENABLED or controller is not None:
+			stats_task = asyncio.create_task(_collect_sender_stats(pc, id(pc), screen_track, controller))
+
+		def handle_input(msg):
+			# 入力があれば静止中の映像をすぐにフルレートへ戻す
+			screen_track.capture.poke()
+			# ワーカーのキューに積む（順序を保ったまま別スレッドで処理）
+			input_worker.submit(msg)
+
+		# クライアントが作った DataChannel から入力を受け取る
+		# （移動は順不同・再送なしのチャネル、ボタン・ホイールは信頼性ありのチャネル。
+		#   移動は相対量の合算なので、到着順が入れ替わっても結果は変わらない）
+		@pc.on("datachannel")
+		def on_datachannel(channel):
+			print("DataChannel opened:", channel.label)
+
+			@channel.on("message")
+			def on_message(message):
+				# バイナリ入力（複数イベントをまとめたもの）
+				if isinstance(message, bytes):
+					try:
+						handle_input(decode_input(message))
+					except ValueError as e:
+						print("Invalid binary input message:", e)
+					return
+				try:
+					msg = json.loads(message)
+				except Exception:
+					print("Received non-json input message")
+					return
+				if msg.get("type") == "input":
+					handle_input(msg)
+
+		# WebSocket が閉じるまでシグナリングメッセージを読み続ける
+		while True:
+			try:
+				msg_raw = await websocket.recv()
+			except Exception:
+				break
+
+			# バイナリ入力（DataChannel を使えないクライアント向けのフォールバック）
+			if isinstance(msg_raw, bytes):
+				try:
+					handle_input(decode_input(msg_raw))
+				except ValueError as e:
+					print("Invalid binary input message:", e)
+				continue
+
+			try:
+				msg = json.loads(msg_raw)
+			except Exception:
+				print("Received non-json signaling message")
+				continue
+
+			# 入力メッセージ（DataChannel を使えないクライアント向けのフォールバック）
+			if msg.get("type") == "input":
+				handle_input(msg)
+				continue
+
+			# 設定の変更（{"type": "config", "settings": {"SCREEN_FPS": 20, ...}}）。
+			# 全接続の動作中のキャプチャ・トラックへ反映し、反映先ごとの項目名を返す
+			if msg.get("type") == "config":
+				values = msg.get("settings")
+				if isinstance(values, dict):
+					# クライアントから変えられるのは画質・遅延などの調整項目だけ（パスやキャプチャ元は config.json で変える）
+					allowed = check_settings({key: value for key, value in values.items() if key in _LIVE_TUNABLE_SETTINGS})
+					changed = settings.update_settings(allowed)
+					result = apply_settings(changed)
+					# 受け付けなかった項目（許可されていない・値が正しくない）も返す
+					result["rejected"] = sorted(
+						key for key in values
+						if key not in changed and (key not in allowed or settings.settings[key] != allowed[key])
+					)
+					await websocket.send(json.dumps({"type": "config", **result}))
+				else:
+					print("Invalid config message:", msg)
+				continue
+
+			# offer の処理
+			if msg.get("type") == "offer" and "sdp" in msg:
+				offer = RTCSessionDescription(sdp=msg["sdp"], type=msg["type"])
+				await pc.setRemoteDescription(offer)
+
+				# バッファした candidate を適用（dict→RTCIceCandidate に変換）
+				for c in candidate_buffer:
+					try:
+						if isinstance(c, dict):
+							rtc_c = RTCIceCandidate(
+								sdpMid=c.get('sdpMid'),
+								sdpMLineIndex=c.get('sdpMLineIndex'),
+								candidate=c.get('candidate')
+							)
+							await pc.addIceCandidate(rtc_c)
+						else:
+							await pc.addIceCandidate(c)
+					except Exception as e:
+						print("Error adding buffered candidate:", e)
+				candidate_buffer.clear()
+
+				# answer を作成して送信
+				answer = await pc.createAnswer()
+				await pc.setLocalDescription(answer)
+				await websocket.send(json.dumps({"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}))
+
+			# candidate の処理
+			elif msg.get("type") == "candidate" and msg.get("candidate"):
+				cand = msg["candidate"]
+				# 受信した candidate dict を RTCIceCandidate に変換
+				try:
+					rtc_cand = RTCIceCandidate(
+						sdpMid=cand.get('sdpMid'),
+						sdpMLineIndex=cand.get('sdpMLineIndex'),
+						candidate=cand.get('candidate')
+					)
+				except Exception:
+					rtc_cand = None
+
+				if pc.remoteDescription is None:
+					# 生の dict をバッファし、適用時に変換する
+					candidate_buffer.append(cand)
+				else:
+					if rtc_cand is not None:
+						try:
+							await pc.addIceCandidate(rtc_cand)
+						except Exception as e:
+							print("Error adding candidate:", e)
+					else:
+						print("Invalid candidate format received:", cand)
+			else:
+				print("Unexpected signaling message:", msg)
+
+	except Exception as e:
+		print("Error in offer handler:", e)
+	finally:
+		# 接続が閉じられた（またはエラーで終わった）ためクリーンアップ。1 段階が失敗しても残りは続ける
+		for task in (watchdog_task, stats_task):
+			if task is not None:
+				task.cancel()
+		if session is not None:
+			# 入力ワーカーは再接続に備えて残し、猶予が過ぎたら止める
+			await _cleanup("session", lambda: session.detach(websocket, settings.SESSION_RESUME_SECONDS))
+		if audio_track is not None:
+			await _cleanup("audio track", audio_track.stop)
+		if screen_track is not None:
+			await _cleanup("screen track", screen_track.stop)
+		if pc is not None:
+			await _cleanup("peer connection", pc.close)
+			pcs.discard(pc)
+		if recorder is not None:
+			await _cleanup("recorder", recorder.close)
+
+async def _cleanup(name, close):
+	"""接続のクリーンアップの 1 段階を実行する（コルーチンなら待つ。失敗はログに出すだけ）"""
+	try:
+		result = close()
+		if asyncio.iscoroutine(result):
+			await result
+	except Exception as e:
+		print(f"Failed to clean up {name}:", e)
+
+# キャプチャ元に関わる設定（キャプチャを作り直してトラックを切り替える）
+_SCREEN_CAPTURE_SETTINGS = {"SCREEN_MONITOR_INDEX", "CAPTURE_MODE", "CAPTURE_REGION", "CAPTURE_BACKEND", "CAPTURE_REPLAY_PATH", "SCENE_CUT_THRESHOLD"}
+_AUDIO_CAPTURE_SETTINGS = {"AUDIO_SAMPLE_RATE", "AUDIO_CHANNELS", "AUDIO_BACKEND", "AUDIO_MAX_LATENCY_MS"}
+# 音声トラックごとの設定（遅延の目標と無音の間引き）
+_AUDIO_TRACK_SETTINGS = {"AUDIO_TARGET_LATENCY_MS", "AUDIO_DTX", "AUDIO_SILENCE_THRESHOLD_DB", "AUDIO_SILENCE_HANG_MS", "AUDIO_DTX_INTERVAL_MS"}
+# 次の接続から反映する設定（トラックの種類・セッションの状態・録画ファイルが接続時に決まるもの）と、サーバーの再起動が必要な設定
+_NEXT_CONNECTION_SETTINGS = {"BROADCAST_MODE", "ADAPTIVE_VIDEO", "ADAPTIVE_LADDER", "RECORD_PATH"}
+_RESTART_SETTINGS = {"METRICS_PORT", "METRICS_LOG_INTERVAL", "LOOP_LAG_LOG_INTERVAL"}
+# WebSocket の config メッセージで変えられる設定（ファイルのパス・キャプチャ元・サーバーやセッションの動作は含めない）
+_LIVE_TUNABLE_SETTINGS = {
+	"SCREEN_FPS", "SCREEN_MONITOR_INDEX", "CAPTURE_REGION", "CAPTURE_OUTPUT_SIZE", "SCREEN_IDLE_FPS", "SCREEN_IDLE_DELAY",
+	"SCENE_CUT_THRESHOLD", "SCENE_CUT_BURST_MS", "BROADCAST_BITRATE",
+	"AUDIO_TARGET_LATENCY_MS", "AUDIO_MAX_LATENCY_MS", "AUDIO_DTX", "AUDIO_SILENCE_THRESHOLD_DB", "AUDIO_SILENCE_HANG_MS", "AUDIO_DTX_INTERVAL_MS",
+	"WHEEL_PIXELS_PER_STEP", "WHEEL_MAX_RATE"
+}
+
+def check_settings(values):
+	"""settings.update_settings に渡す前に、動作中の環境で使えない値（存在しないモニター番号）を除いて返す"""
+	index = values.get("SCREEN_MONITOR_INDEX", settings.SCREEN_MONITOR_INDEX)
+	backend = values.get("CAPTURE_BACKEND", settings.CAPTURE_BACKEND)
+	# 合成画面と動画の再生は、指定した番号までのモニターを用意する
+	if index == settings.SCREEN_MONITOR_INDEX or backend != "mss" or not isinstance(index, int):
+		return values
+	try:
+		count = monitor_count()
+		if 0 <= index < count:
+			return values
+		print(f"Ignoring SCREEN_MONITOR_INDEX={index}: no such monitor (valid: 0-{count - 1})")
+	except Exception as e:
+		print(f"Ignoring SCREEN_MONITOR_INDEX={index}: cannot list monitors ({e})")
+	return {key: value for key, value in values.items() if key != "SCREEN_MONITOR_INDEX"}
+
+def apply_settings(changed):
+	"""変更された設定（settings.update_settings の戻り値）を動作中のキャプチャとトラックに反映する。
+
+	キャプチャ元に関わる項目は新しい共有キャプチャを作って動作中のトラックを切り替え、
+	それ以外は動作中のオブジェクトの値を書き換える。どちらも再ネゴシエーションはしない
+	（解像度が変わればエンコーダーが開き直す）。反映先ごとの項目名を返す。
+	"""
+	keys = set(changed)
+	if keys & _SCREEN_CAPTURE_SETTINGS:
+		# 使っていたキャプチャは保持せずにすぐ止める（新しいキャプチャと同時にグラブしない）
+		for capture in {track.capture for track in _screen_tracks}:
+			discard_screen_capture(capture.monitor_index)
+			capture.close()
+		discard_screen_capture(settings.SCREEN_MONITOR_INDEX)
+		capture = _screen_capture(settings.SCREEN_MONITOR_INDEX)
+		# 配信モードの視聴者の解像度の要求も一緒に移す
+		if _broadcaster is not None:
+			_broadcaster.switch_capture(capture)
+		for track in list(_screen_tracks):
+			track.switch_capture(capture)
+	for capture in screen_captures():
+		if "SCREEN_FPS" in keys:
+			capture.set_fps(settings.SCREEN_FPS)
+		if "SCREEN_IDLE_DELAY" in keys:
+			capture.idle_delay = settings.SCREEN_IDLE_DELAY
+		if "CAPTURE_OUTPUT_SIZE" in keys:
+			capture.set_output_size(settings.CAPTURE_OUTPUT_SIZE)
+		if "SESSION_RESUME_SECONDS" in keys:
+			capture.linger = settings.SESSION_RESUME_SECONDS
+	for track in list(_screen_tracks):
+		if "SCREEN_FPS" in keys:
+			track.set_fps(settings.SCREEN_FPS)
+		if "SCREEN_IDLE_FPS" in keys:
+			track.idle_frame_time = 1.0 / settings.SCREEN_IDLE_FPS
+		if "SCENE_CUT_BURST_MS" in keys:
+			track.burst_time = settings.SCENE_CUT_BURST_MS / 1000
+	if "BROADCAST_BITRATE" in keys and _broadcaster is not None:
+		# 共有エンコーダーは次のフレームで開き直す
+		_broadcaster.bitrate = settings.BROADCAST_BITRATE
+	if keys & _AUDIO_CAPTURE_SETTINGS:
+		# 同じデバイスを別の形式で開き直すため、使っていたキャプチャは先に閉じる
+		for capture in {track.capture for track in _audio_tracks}:
+			discard_audio_capture(capture.samplerate, capture.channels, capture.device_id)
+			capture.close()
+		discard_audio_capture(settings.AUDIO_SAMPLE_RATE, settings.AUDIO_CHANNELS)
+		capture = _audio_capture(settings.AUDIO_SAMPLE_RATE, settings.AUDIO_CHANNELS)
+		for track in list(_audio_tracks):
+			track.switch_capture(capture)
+	if "SESSION_RESUME_SECONDS" in keys:
+		for capture in audio_captures():
+			capture.linger = settings.SESSION_RESUME_SECONDS
+	if keys & _AUDIO_TRACK_SETTINGS:
+		for track in list(_audio_tracks):
+			track.reconfigure()
+	if keys & {"WHEEL_PIXELS_PER_STEP", "WHEEL_MAX_RATE"}:
+		for session in sessions.values():
+			session.input_worker.wheel_step = settings.WHEEL_PIXELS_PER_STEP
+			session.input_worker.wheel_interval = 1.0 / settings.WHEEL_MAX_RATE
+	result = {
+		"applied": sorted(keys - _NEXT_CONNECTION_SETTINGS - _RESTART_SETTINGS),
+		"next_connection": sorted(keys & _NEXT_CONNECTION_SETTINGS),
+		"restart": sorted(keys & _RESTART_SETTINGS),
+	}
+	for kind, names in result.items():
+		if names:
+			print(f"Settings {kind}: {', '.join(names)}")
+	return result
+
+def _apply_video_level(screen_track, controller):
+	"""AdaptiveController の段階を映像トラックに適用する（0 段目は通常の設定）"""
+	if controller.level == 0:
+		size, fps = None, None
+	else:
+		width, height, fps = controller.rung
+		size = (width, height)
+	screen_track.set_quality(size, fps)
+	print(f"Adaptive video: level {controller.level} (size={size or 'full'}, fps={screen_track.fps})")
+	_VIDEO_LEVEL.set((("track", screen_track.id),), controller.level)
+
+async def _collect_sender_stats(pc, peer, screen_track=None, controller=None, interval=SENDER_STATS_INTERVAL):
+	"""送信ストリームのビットレートと受信側から報告された RTT・損失率をゲージに記録する。
+
+	controller を渡すと、映像の受信レポートから段階を決めて screen_track に適用する。
+	受信レポートが届かなくなった（回線がほぼ途切れた）場合は損失率 1 として扱う。
+	"""
+	last_bytes = {}
+	labels = set()
+	last_report = None
+	stale = 0
+	try:
+		while True:
+			await asyncio.sleep(interval)
+			try:
+				report = await pc.getStats()
+			except Exception as e:
+				print("Failed to collect sender stats:", e)
+				continue
+			video = None
+			for stats in report.values():
+				if stats.type not in ("outbound-rtp", "remote-inbound-rtp"):
+					continue
+				key = (("peer", peer), ("kind", stats.kind))
+				if stats.type == "outbound-rtp":
+					previous = last_bytes.get(stats.kind)
+					last_bytes[stats.kind] = stats.bytesSent
+					if previous is not None:
+						_SEND_BITRATE.set(key, (stats.bytesSent - previous) * 8 / interval)
+						labels.add(key)
+				elif stats.type == "remote-inbound-rtp":
+					# fractionLost は RTCP の 8bit 値（256 で 100%）
+					loss = stats.fractionLost / 256
+					if stats.roundTripTime is not None:
+						_RTT_SECONDS.set(key, stats.roundTripTime)
+					_FRACTION_LOST.set(key, loss)
+					labels.add(key)
+					if stats.kind == "video":
+						video = stats
+			if controller is None or video is None:
+				continue
+			if video.timestamp == last_report:
+				# 前回から受信レポートが来ていない
+				stale += 1
+				changed = stale >= 2 and controller.update(1.0)
+			else:
+				stale = 0
+				last_report = video.timestamp
+				changed = controller.update(
+					video.fractionLost / 256,
+					video.roundTripTime,
+					video.jitter / VIDEO_CLOCK_RATE
+				)
+			if changed:
+				_apply_video_level(screen_track, controller)
+	except asyncio.CancelledError:
+		pass
+	finally:
+		for key in labels:
+			_SEND_BITRATE.remove(key)
+			_RTT_SECONDS.remove(key)
+			_FRACTION_LOST.remove(key)
+		if screen_track is not None:
+			_VIDEO_LEVEL.remove((("track", screen_track.id),))
+
+async def warm_up(timeout=5.0):
+	"""共有の画面・音声キャプチャを先に開き、開くのにかかった時間（秒）を返す。
+
+	開いたキャプチャは SESSION_RESUME_SECONDS の間だけ保持されるため、その間に来た
+	最初の接続はデバイスを開く時間を待たずに済む。
+	"""
+	timings = {}
+	started = time.perf_counter()
+	screen_track = ScreenTrack()
+	try:
+		await asyncio.wait_for(screen_track.capture.latest(), timeout)
+		timings["screen_capture"] = time.perf_counter() - started
+	except (asyncio.TimeoutError, MediaStreamError):
+		print("Screen capture did not produce a frame during warm-up")
+	finally:
+		screen_track.stop()
+	started = time.perf_counter()
+	audio_track = SystemAudioTrack()
+	audio_track.start_recording()
+	audio_track.stop()
+	timings["audio_capture"] = time.perf_counter() - started
+	return timings
@@ -0,0 +1,241 @@
+import fractions
+import os
+import queue
+import threading
+import time
+import av
+import aiortc
+from aiortc.codecs import depayload
+from metrics import gauge, histogram
+
+
+# 書き込み待ちにできるエンコード済みフレームの数（映像 30fps・音声 50 フレーム/秒で数秒分）
+WRITE_QUEUE_SIZE = 400
+# 最初のフレームから、まだフレームの来ていない送信側を待つ秒数（過ぎたら来ている分だけで書き始める）
+START_WAIT = 2.0
+# 取りこぼしが続く間にキーフレームを要求する最短の間隔（秒）
+KEYFRAME_REQUEST_INTERVAL = 1.0
+
+# RTP のコーデック名 → コンテナに書くときのコーデック名
+_CODEC_NAMES = {
+	"VP8": "vp8",
+	"H264": "h264",
+	"opus": "opus",
+	"PCMU": "pcm_mulaw",
+	"PCMA": "pcm_alaw",
+}
+
+_WRITE_SECONDS = histogram("recorder_write_seconds", "Mux and disk write time per encoded frame")
+_DROPPED_FRAMES = gauge("recorder_dropped_frames", "Encoded frames dropped because the recording writer fell behind")
+
+
+class _Track:
+	"""1 つの送信側（映像または音声）の録画の状態。writer スレッドだけが触る"""
+
+	def __init__(self, kind):
+		self.kind = kind
+		self.codec = None
+		self.stream = None
+		self.first_timestamp = None
+		self.first_arrival = None
+		# 映像の長さと種類を調べるパーサー（ビットストリームを区切るだけで、デコードはしない）
+		self.parser = None
+		self.pending_pts = []
+		# 解像度をヘッダーに設定したか（映像のみ。設定するまで mux しない）
+		self.sized = kind != "video"
+		# 取りこぼしの後は、キーフレームが来るまで映像を書かない
+		self.waiting_keyframe = kind == "video"
+		self.gaps_seen = 0
+
+
+class SessionRecorder:
+	"""送信側（RTCRtpSender）がエンコードしたフレームをそのまま動画ファイルへ書き出す。
+
+	tap() した送信側のエンコード済みフレームを RTP ペイロードから元のビットストリームへ戻し、
+	デコードも再エンコードもせずに PyAV でコンテナへ mux する。コンテナは path の拡張子で決まり、
+	VP8 は .mkv / .webm、H264 は .mkv / .mp4 に書ける（音声は Opus）。
+
+	ペイロードを戻す処理と書き込みは専用スレッドが行い、送信側はキューに積むだけ。
+	キューは queue_size フレームまでで、ディスクが遅くて溢れた分は捨てて dropped に数える
+	（映像は次のキーフレームから書き直す）。配信側が書き込みを待つことはない。
+	"""
+
+	def __init__(self, path, queue_size=WRITE_QUEUE_SIZE):
+		self.path = path
+		self.dropped = 0
+		self.written = 0
+		self._queue = queue.Queue(queue_size)
+		self._tracks = {}
+		# 取りこぼし後のキーフレーム要求（送信側ごと）と、取りこぼしの回数（送信側が数え、writer が見る）
+		self._request_keyframe = {}
+		self._gaps = {}
+		self._last_keyframe_request = 0.0
+		self._closing = threading.Event()
+		self._container = None
+		# 映像の解像度が分かる（ヘッダーを書ける）まで mux を待たせるパケット
+		self._held = []
+		self._thread = threading.Thread(target=self._run, name="SessionRecorder", daemon=True)
+		self._thread.start()
+		print(f"Recording to {path}")
+
+	def tap(self, sender, request_keyframe=None):
+		"""sender が送るエンコード済みフレームを録画する（接続の開始前に呼ぶ）。
+
+		request_keyframe を渡すと、取りこぼした後の映像をキーフレームから再開できるよう要求する。
+		"""
+		# aiortc の非公開メソッドを差し替える（requirements.txt で固定した 1.15 系にあるもの）
+		next_encoded_frame = getattr(sender, "_next_encoded_frame", None)
+		if next_encoded_frame is None:
+			raise RuntimeError(
+				f"Recording needs RTCRtpSender._next_encoded_frame, which aiortc {aiortc.__version__} does not have; "
+				"install aiortc 1.15.x (requirements.txt)"
+			)
+		kind = sender.kind
+		self._tracks[kind] = _Track(kind)
+		self._request_keyframe[kind] = request_keyframe
+		self._gaps[kind] = 0
+
+		async def _next_encoded_frame(codec):
+			frame = await next_encoded_frame(codec)
+			if frame is not None and not self._closing.is_set():
+				self._put(kind, codec, frame)
+			return frame
+
+		sender._next_encoded_frame = _next_encoded_frame
+
+	def _put(self, kind, codec, frame):
+		try:
+			self._queue.put_nowait((kind, codec, frame.payloads, frame.timestamp, time.monotonic()))
+		except queue.Full:
+			self.dropped += 1
+			self._gaps[kind] += 1
+			_DROPPED_FRAMES.set((("path", self.path),), self.dropped)
+			# 書き込みが追いつくまでは捨て続け、映像は次のキーフレームから書き直す
+			request_keyframe = self._request_keyframe[kind]
+			now = time.monotonic()
+			if request_keyframe is not None and now - self._last_keyframe_request >= KEYFRAME_REQUEST_INTERVAL:
+				self._last_keyframe_request = now
+				request_keyframe()
+
+	def close(self):
+		"""録画を終える（キューに残った分を書き終えてからファイルを閉じる。待たずに戻る）"""
+		self._closing.set()
+
+	def _run(self):
+		buffered = []
+		started = None
+		try:
+			while True:
+				try:
+					item = self._queue.get(timeout=0.2)
+				except queue.Empty:
+					if self._closing.is_set():
+						break
+					item = None
+				if self._container is None:
+					if item is not None:
+						buffered.append(item)
+						started = started or time.monotonic()
+					# 全送信側のコーデックが分かるまで（最大 START_WAIT 秒）ヘッダーを書かずに溜める
+					kinds = {kind for kind, *_ in buffered}
+					if not buffered or (kinds != set(self._tracks) and time.monotonic() - started < START_WAIT):
+						continue
+					self._open(buffered)
+					items, buffered = buffered, []
+				else:
+					items = [item] if item is not None else []
+				for item in items:
+					self._write(*item)
+		except Exception as e:
+			print(f"Recording error ({self.path}): {e}")
+		finally:
+			# 書き込みをやめたら送信側もキューに積むのをやめる
+			self._closing.set()
+			self._finish()
+
+	def _open(self, items):
+		os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+		self._container = av.open(self.path, "w")
+		start = min(arrival for *_, arrival in items)
+		for kind, codec, payloads, timestamp, arrival in items:
+			track = self._tracks[kind]
+			if track.codec is not None:
+				continue
+			name = _CODEC_NAMES.get(codec.name)
+			if name is None:
+				print(f"Recording skips unsupported codec {codec.mimeType}")
+				track.codec = codec
+				continue
+			track.codec = codec
+			track.first_timestamp = timestamp
+			# 送信側ごとの RTP タイムスタンプの起点の差を、最初のフレームが届いた時刻で揃える
+			track.first_arrival = int((arrival - start) * codec.clockRate)
+			if kind == "video":
+				track.stream = self._container.add_stream(name)
+				track.parser = av.CodecContext.create(name, "r")
+			else:
+				track.stream = self._container.add_stream(name, rate=codec.clockRate)
+			track.stream.time_base = fractions.Fraction(1, codec.clockRate)
+		print(f"Recording streams: {', '.join(t.codec.name for t in self._tracks.values() if t.stream is not None)}")
+
+	def _write(self, kind, codec, payloads, timestamp, arrival):
+		track = self._tracks[kind]
+		if track.stream is None:
+			return
+		started = time.perf_counter()
+		data = b"".join(depayload(codec, payload) for payload in payloads)
+		pts = (timestamp - track.first_timestamp) % (1 << 32) + track.first_arrival
+		if track.parser is None:
+			self._mux(track, av.Packet(data), pts)
+		else:
+			if track.gaps_seen != self._gaps[kind]:
+				track.gaps_seen = self._gaps[kind]
+				track.waiting_keyframe = True
+			# パーサーは区切りが分かった時点で前のフレームを返すことがある（H264）ため、pts は順に対応させる
+			track.pending_pts.append(pts)
+			for packet in track.parser.parse(data):
+				self._mux_video(track, packet)
+		_WRITE_SECONDS.observe(time.perf_counter() - started)
+
+	def _mux_video(self, track, packet):
+		pts = track.pending_pts.pop(0)
+		if track.waiting_keyframe:
+			if not packet.is_keyframe:
+				return
+			track.waiting_keyframe = False
+		if not track.sized:
+			# ヘッダーに書く解像度（最初のキーフレームからパーサーが読み取る）
+			track.stream.width = track.parser.width
+			track.stream.height = track.parser.height
+			track.sized = True
+		self._mux(track, packet, pts)
+
+	def _mux(self, track, packet, pts):
+		packet.stream = track.stream
+		packet.pts = packet.dts = pts
+		packet.time_base = fractions.Fraction(1, track.codec.clockRate)
+		self._held.append(packet)
+		# 最初の mux でヘッダーが書かれるため、全映像ストリームの解像度が決まるまで待つ
+		if any(t.stream is not None and not t.sized for t in self._tracks.values()):
+			if len(self._held) > WRITE_QUEUE_SIZE:
+				self._held.pop(0)
+				self.dropped += 1
+			return
+		for held in self._held:
+			self._container.mux(held)
+		self.written += len(self._held)
+		self._held.clear()
+
+	def _finish(self):
+		try:
+			if self._container is not None:
+				for track in self._tracks.values():
+					if track.parser is not None and track.stream is not None:
+						# パーサーに残っている最後のフレーム
+						for packet in track.parser.parse(None):
+							self._mux_video(track, packet)
+				self._container.close()
+		except Exception as e:
+			print(f"Failed to finish recording ({self.path}): {e}")
+		_DROPPED_FRAMES.remove((("path", self.path),))
+		print(f"Recording finished: {self.path} ({self.written} frames written, {self.dropped} dropped)")
@@ -1,386 +1,146 @@
+import time
+# 起動時間の計測の基準（ここから下の import は軽いものだけにする）
+_STARTED = time.perf_counter()
+import argparse
 import asyncio
-import json
-import websockets
-from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack, AudioStreamTrack, RTCIceCandidate
-import cv2
-import numpy as np
-import mss
-import sounddevice as sd
+import importlib
 import os
-import fractions
-import time
-from pynput.mouse import Controller, Button
-import ctypes
-_mouse = Controller()
-# カーソル描画のスケール
-CURSOR_SCALE = 3.0
-# マウス移動のスピードスケール
-MOUSE_MOVE_SCALE = 1.7
-
-
-
-# 設定ファイルの絶対パスを取得
-CONFIG_FILE = os.path.join(os.path.dirname(__file__), "config.json")
-
-# デフォルト設定
-default_settings = {
-    "SCREEN_FPS": 30,
-    "SCREEN_MONITOR_INDEX": 2,
-    "AUDIO_SAMPLE_RATE": 48000,
-    "AUDIO_CHANNELS": 1,
-    "SERVER_IP": "192.168.128.125"
-}
-
-# 設定を読み込む関数
-def load_settings():
-    try:
-        with open(CONFIG_FILE, "r") as f:
-            settings = json.load(f)
-            print("読み込んだ設定:", settings)  # デバッグ用出力
-            return settings
-    except FileNotFoundError:
-        print("設定ファイルが見つかりません。デフォルト設定を使用します。")
-        return default_settings
-
-# 設定を読み込む
-settings = load_settings()
-
-# 画面キャプチャ設定
-SCREEN_FPS = settings["SCREEN_FPS"]
-SCREEN_MONITOR_INDEX = settings["SCREEN_MONITOR_INDEX"]
-
-# 音声キャプチャ設定
-AUDIO_SAMPLE_RATE = settings["AUDIO_SAMPLE_RATE"]
-AUDIO_CHANNELS = settings["AUDIO_CHANNELS"]
-
-# サーバーのIPアドレス設定
-SERVER_IP = settings["SERVER_IP"]
-
-class SystemAudioTrack(AudioStreamTrack):
-	kind = "audio"
-
-	def __init__(self, samplerate=AUDIO_SAMPLE_RATE, channels=AUDIO_CHANNELS, device_id=None):
-		super().__init__()
-		self.samplerate = samplerate
-		self.channels = channels
-		self.q = asyncio.Queue()
-		self.loop = asyncio.get_event_loop()
-		self.stream = None
-		self.device_id = device_id
-		self._pts = 0
-
-	def start_recording(self):
-		print("Starting audio recording...")
-		blocksize = int(self.samplerate * 0.02)
+import websockets
+from metrics import gauge, log_metrics, publish_stats, start_metrics_server
+_IMPORTED = time.perf_counter()
+import settings
+from settings import LOOP_LAG_LOG_INTERVAL, METRICS_LOG_INTERVAL, METRICS_PORT
+_CONFIGURED = time.perf_counter()
+
+# 起動の段階ごとの所要時間
+_STARTUP_SECONDS = gauge("server_startup_seconds", "Time spent in each startup phase")
+
+# WebRTC とメディア処理（aiortc・numpy・cv2・mss・sounddevice・pynput）は peer モジュールにまとめ、
+# シグナリングの待ち受けを始めてからバックグラウンドで読み込む
+_peer_ready = None
+
+def _report(title, timings):
+	"""段階ごとの所要時間（秒）をログ出力し、メトリクスにも記録する"""
+	for phase, seconds in timings.items():
+		_STARTUP_SECONDS.set((("phase", phase),), round(seconds, 4))
+	print(f"{title}: " + ", ".join(f"{phase}={seconds * 1000:.0f}ms" for phase, seconds in timings.items()))
+
+async def _load_peer():
+	"""peer モジュールを別スレッドで読み込み、続けて共有キャプチャを開いておく"""
+	loop = asyncio.get_event_loop()
+	started = time.perf_counter()
+	try:
+		peer = await loop.run_in_executor(None, importlib.import_module, "peer")
+	except Exception as e:
+		print("Failed to load media modules:", e)
+		raise
+	timings = {"media_imports": time.perf_counter() - started}
+	# 保持時間が 0 なら開いてもすぐ閉じるため、最初の接続で開く
+	if settings.SESSION_RESUME_SECONDS > 0:
 		try:
-			if self.device_id is not None:
-				self.stream = sd.InputStream(
-					device=self.device_id,
-					samplerate=self.samplerate,
-					channels=self.channels,
-					dtype='int16',
-					callback=self._audio_callback,
-					blocksize=blocksize
-				)
-			else:
-				self.stream = sd.InputStream(
-					samplerate=self.samplerate,
-					channels=self.channels,
-					dtype='int16',
-					callback=self._audio_callback,
-					blocksize=blocksize
-				)
-			self.stream.start()
-			print(f"Audio stream started (device={self.device_id})")
+			timings.update(await peer.warm_up())
 		except Exception as e:
-			print(f"Error starting audio stream: {e}")
-
-	def _audio_callback(self, indata, frames, time, status):
-		if status:
-			print(status)
-		# asyncio キューにスレッド安全にコピーをプッシュする
-		self.loop.call_soon_threadsafe(self.q.put_nowait, indata.copy())
-
-	def stop_recording(self):
-		print("Stopping audio recording...")
-		if self.stream:
-			self.stream.stop()
-			self.stream.close()
-
-	async def recv(self):
-		from av import AudioFrame
-		# 次のチャンクを待つ
-		data = await self.q.get()
-		# データ形状: (samples, channels)
-		samples = data.shape[0]
-		layout = 'mono' if self.channels == 1 else 'stereo'
-		frame = AudioFrame(format='s16', layout=layout, samples=samples)
-		frame.planes[0].update(data.tobytes())
-		frame.sample_rate = self.samplerate
-
-		# サンプル数に基づいて pts/time_base を設定
-		frame.pts = self._pts
-		frame.time_base = fractions.Fraction(1, self.samplerate)
-		self._pts += samples
-		return frame
-
-	async def stop(self):
-		self.stop_recording()
-		print("Audio track stopped.")
-
-# 画面キャプチャ用VideoStreamTrack
-class ScreenTrack(VideoStreamTrack):
-	def __init__(self, fps=SCREEN_FPS, monitor_index=SCREEN_MONITOR_INDEX):
-		super().__init__()
-		self.sct = mss.mss()
-		self.monitor = self.sct.monitors[monitor_index]
-		self.fps = fps
-		self.frame_time = 1.0 / fps
-		self._last_frame = 0
+			print("Warm-up failed:", e)
+	_report("Background warm-up", timings)
+	return peer
 
-	async def recv(self):
-		from av import VideoFrame
-		pts, time_base = await self.next_timestamp()
-		# フレームレート制御
-		now = asyncio.get_event_loop().time()
-		wait = self._last_frame + self.frame_time - now
-		if wait > 0:
-			await asyncio.sleep(wait)
-		self._last_frame = asyncio.get_event_loop().time()
-		img = np.array(self.sct.grab(self.monitor))
-		frame = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
-		# カーソル合成（簡易）
+async def _watch_config(interval=1.0):
+	"""config.json の更新を監視し、変更された設定を動作中のキャプチャとトラックへ反映する"""
+	def mtime():
 		try:
-			if _mouse is not None:
-				cx, cy = _mouse.position
-				# monitor の左上オフセットを引く
-				mx = int(cx - self.monitor.get('left', 0))
-				my = int(cy - self.monitor.get('top', 0))
-				h, w = frame.shape[:2]
-				if 0 <= mx < w and 0 <= my < h:
-					# 矢印形ポインターを描画（拡大）
-					# スケールを適用して外側（黒）→内側（白）を描画
-					s = CURSOR_SCALE
-					pts_outer = np.array([
-						[mx, my],
-						[mx + int(18 * s), my + int(8 * s)],
-						[mx + int(8 * s), my + int(18 * s)]
-					], np.int32)
-					pts_outer = pts_outer.reshape((-1, 1, 2))
-					cv2.fillPoly(frame, [pts_outer], (0, 0, 0), lineType=cv2.LINE_AA)
-					pts_inner = np.array([
-						[mx + int(2 * s), my + int(2 * s)],
-						[mx + int(14 * s), my + int(7 * s)],
-						[mx + int(7 * s), my + int(14 * s)]
-					], np.int32)
-					pts_inner = pts_inner.reshape((-1, 1, 2))
-					cv2.fillPoly(frame, [pts_inner], (255, 255, 255), lineType=cv2.LINE_AA)
-		except Exception:
-			pass
-		video_frame = VideoFrame.from_ndarray(frame, format="bgr24")
-		video_frame.pts = pts
-		video_frame.time_base = time_base
-		return video_frame
-
-# シグナリングサーバー
-pcs = set()
-
-async def offer(websocket, path):
-	try:
-		pc = RTCPeerConnection()
-		pcs.add(pc)
-		print("Created for", path)
-
-		# 画面キャプチャトラックを追加
-		screen_track = ScreenTrack(fps=SCREEN_FPS, monitor_index=SCREEN_MONITOR_INDEX)
-		pc.addTrack(screen_track)
-
-		# 音声キャプチャトラックを追加
-		audio_track = SystemAudioTrack()
-		audio_track.start_recording()  # クライアント接続時に録音開始
-		pc.addTrack(audio_track)
-
-		# send server ICE candidates to client
-		@pc.on("icecandidate")
-		async def on_icecandidate(candidate):
-			if candidate:
-				try:
-					await websocket.send(json.dumps({"type": "candidate", "candidate": candidate}))
-				except Exception as e:
-					print("Failed to send candidate:", e)
-
-		# リモート記述が設定されるまで到着する candidate を一時バッファする
-		candidate_buffer = []
-
-		# ボタンが押されたままか追跡
-		pressed_buttons = {}
-
-		async def _release_stuck_buttons():
-			import time
-			while True:
-				now = time.time()
-				for b, ts in list(pressed_buttons.items()):
-					if now - ts > 5.0:
-						print(f"Releasing stuck button: {b}")
-						try:
-							_mouse.release(Button.left if b == 'left' else Button.right)
-						except Exception as e:
-							print('watchdog release error', e)
-						pressed_buttons.pop(b, None)
-				await asyncio.sleep(1.0)
-
-		# この接続用の watchdog タスクを開始
-		watchdog_task = asyncio.create_task(_release_stuck_buttons())
-
-		# WebSocket が閉じるまでシグナリングメッセージを読み続ける
-		while True:
-			try:
-				msg_raw = await websocket.recv()
-			except Exception:
-				break
-
-			try:
-				msg = json.loads(msg_raw)
-			except Exception:
-				print("Received non-json signaling message")
-				continue
-
-			# 入力メッセージ（クライアントのオーバーレイから受信）
-			if msg.get("type") == "input":
-				def handle_input(m):
-					if _mouse is None:
-						print("Mouse controller not available")
-						return
-					try:
-						# 画面サイズ（Windows）取得
-						try:
-							screen_w = ctypes.windll.user32.GetSystemMetrics(0)
-							screen_h = ctypes.windll.user32.GetSystemMetrics(1)
-						except Exception:
-							# フォールバック: 1920x1080
-							screen_w, screen_h = 1920, 1080
-						if m.get('input') == 'mouse':
-							# 相対移動のみサポート（dx/dy は正規化）
-							action = m.get('action')
-							# 相対移動を適用
-							if 'dx' in m or 'dy' in m:
-								dx_norm = float(m.get('dx', 0))
-								dy_norm = float(m.get('dy', 0))
-								# 画面幅/高さに基づくピクセル量にスケールを適用
-								dx_px = int(dx_norm * screen_w * MOUSE_MOVE_SCALE)
-								dy_px = int(dy_norm * screen_h * MOUSE_MOVE_SCALE)
-								try:
-									_mouse.move(dx_px, dy_px)
-								except Exception:
-									# フォールバック: 現在位置へオフセット移動
-									try:
-										cx, cy = _mouse.position
-										_mouse.position = (int(cx + dx_px), int(cy + dy_px))
-									except Exception:
-										pass
-							# ボタン操作（click/down/up）を処理
-							if action == 'click':
-								button_name = m.get('button', 'left')
-								button = Button.left if button_name == 'left' else Button.right
-								try:
-									_mouse.click(button)
-								except Exception as e:
-									print('click error', e)
-							elif action == 'down':
-								button_name = m.get('button', 'left')
-								button = Button.left if button_name == 'left' else Button.right
-								_mouse.press(button)
-								pressed_buttons[button_name] = time.time()
-							elif action == 'up':
-								button_name = m.get('button', 'left')
-								button = Button.left if button_name == 'left' else Button.right
-								try:
-									_mouse.release(button)
-								except Exception as e:
-									print('release error', e)
-								pressed_buttons.pop(button_name, None)
-					except Exception as e:
-						print('handle_input error', e)
-				# スレッドに処理を委譲
-				asyncio.get_event_loop().run_in_executor(None, handle_input, msg)
-				continue
-
-			# offer の処理
-			if msg.get("type") == "offer" and "sdp" in msg:
-				offer = RTCSessionDescription(sdp=msg["sdp"], type=msg["type"])
-				await pc.setRemoteDescription(offer)
-
-				# バッファした candidate を適用（dict→RTCIceCandidate に変換）
-				for c in candidate_buffer:
-					try:
-						if isinstance(c, dict):
-							rtc_c = RTCIceCandidate(
-								sdpMid=c.get('sdpMid'),
-								sdpMLineIndex=c.get('sdpMLineIndex'),
-								candidate=c.get('candidate')
-							)
-							await pc.addIceCandidate(rtc_c)
-						else:
-							await pc.addIceCandidate(c)
-					except Exception as e:
-						print("Error adding buffered candidate:", e)
-				candidate_buffer.clear()
-
-				# answer を作成して送信
-				answer = await pc.createAnswer()
-				await pc.setLocalDescription(answer)
-				await websocket.send(json.dumps({"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}))
-
-			# candidate の処理
-			elif msg.get("type") == "candidate" and msg.get("candidate"):
-				cand = msg["candidate"]
-				# 受信した candidate dict を RTCIceCandidate に変換
-				try:
-					rtc_cand = RTCIceCandidate(
-						sdpMid=cand.get('sdpMid'),
-						sdpMLineIndex=cand.get('sdpMLineIndex'),
-						candidate=cand.get('candidate')
-					)
-				except Exception:
-					rtc_cand = None
-
-				if pc.remoteDescription is None:
-					# 生の dict をバッファし、適用時に変換する
-					candidate_buffer.append(cand)
-				else:
-					if rtc_cand is not None:
-						try:
-							await pc.addIceCandidate(rtc_cand)
-						except Exception as e:
-							print("Error adding candidate:", e)
-					else:
-						print("Invalid candidate format received:", cand)
-			else:
-				print("Unexpected signaling message:", msg)
-
-		# 接続が閉じられたためクリーンアップ
-		# watchdog をキャンセル
+			return os.stat(settings.CONFIG_FILE).st_mtime
+		except OSError:
+			return None
+	last = mtime()
+	failed = None
+	while True:
+		await asyncio.sleep(interval)
+		current = mtime()
+		if current == last:
+			continue
+		# peer の読み込み前なら、読み込み時に新しい値が使われる
+		peer = _peer_ready.result() if _peer_ready is not None and _peer_ready.done() and _peer_ready.exception() is None else None
 		try:
-			watchdog_task.cancel()
-		except Exception:
-			pass
-		await audio_track.stop()
-		await pc.close()
-		pcs.discard(pc)
-
-	except Exception as e:
-		print("Error in offer handler:", e)
-
-async def main():
+			values = settings.load_settings()
+			# 動作中の環境で使えない値（存在しないモニター番号）は反映しない
+			if peer is not None:
+				values = peer.check_settings(values)
+			changed = settings.update_settings(values)
+		except Exception as e:
+			# 書き込み途中のファイルなどは次の周期で読み直す（ログは更新 1 回につき 1 度だけ）
+			if failed != current:
+				failed = current
+				print("Failed to reload settings:", e)
+			continue
+		last = current
+		if changed and peer is not None:
+			peer.apply_settings(changed)
+
+async def handle_connection(websocket, path=None):
+	# メディア処理の読み込みが終わっていなければ待ってから接続を処理する
+	peer = await asyncio.shield(_peer_ready)
+	await peer.offer(websocket, path)
+
+async def _log_loop_lag(interval, tick=0.005):
+	"""イベントループの停止時間（予定より遅れて起床した時間）を計測してログ出力する"""
+	loop = asyncio.get_event_loop()
+	max_lag = 0.0
+	total_lag = 0.0
+	samples = 0
+	last_log = loop.time()
+	while True:
+		start = loop.time()
+		await asyncio.sleep(tick)
+		lag = loop.time() - start - tick
+		if lag > 0:
+			total_lag += lag
+			max_lag = max(max_lag, lag)
+		samples += 1
+		if loop.time() - last_log >= interval:
+			print(f"Event loop lag: max={max_lag * 1000:.1f}ms avg={total_lag / samples * 1000:.2f}ms")
+			max_lag = 0.0
+			total_lag = 0.0
+			samples = 0
+			last_log = loop.time()
+
+async def main(stats_port=0):
+	global _peer_ready
 	host = '0.0.0.0'
 	port = 8765
+	if stats_port > 0:
+		# GUI のダッシュボードへ送る。接続ごとの送信統計も集めるよう、peer を読み込む前に有効にする
+		settings.METRICS_ENABLED = True
+		asyncio.create_task(publish_stats(stats_port))
+	if LOOP_LAG_LOG_INTERVAL > 0:
+		asyncio.create_task(_log_loop_lag(LOOP_LAG_LOG_INTERVAL))
+	if METRICS_PORT > 0:
+		try:
+			await start_metrics_server(METRICS_PORT)
+		except Exception as e:
+			print(f"Failed to start metrics endpoint on port {METRICS_PORT}: {e}")
+	if METRICS_LOG_INTERVAL > 0:
+		asyncio.create_task(log_metrics(METRICS_LOG_INTERVAL))
 	try:
-		async with websockets.serve(offer, host, port):
+		bind_started = time.perf_counter()
+		async with websockets.serve(handle_connection, host, port):
+			ready = time.perf_counter()
 			print(f"Signaling server started on ws://{host}:{port}")
+			_report("Startup", {
+				"imports": _IMPORTED - _STARTED,
+				"config": _CONFIGURED - _IMPORTED,
+				"socket_bind": ready - bind_started,
+				"ready": ready - _STARTED,
+			})
+			_peer_ready = asyncio.ensure_future(_load_peer())
+			# 設定ファイルの変更はサーバーを再起動せずに反映する
+			asyncio.create_task(_watch_config())
 			await asyncio.Future()  # 常時実行（永久待機）
 	except Exception as e:
 		print(f"Failed to start signaling server on {host}:{port}: {e}")
 		raise
 
 if __name__ == "__main__":
-	asyncio.run(main())
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--stats-port", type=int, default=0, help="統計を JSON で送る 127.0.0.1 の UDP ポート（設定 GUI が指定する）")
+	args = parser.parse_args()
+	asyncio.run(main(args.stats_port))
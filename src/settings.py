@@ -0,0 +1,228 @@
+import json
+import os
+
+
+# 設定ファイルの絶対パスを取得
+CONFIG_FILE = os.path.join(os.path.dirname(__file__), "config.json")
+
+# デフォルト設定
+default_settings = {
+    "SCREEN_FPS": 30,
+    "SCREEN_MONITOR_INDEX": 2,
+    "AUDIO_SAMPLE_RATE": 48000,
+    "AUDIO_CHANNELS": 1,
+    "SERVER_IP": "192.168.128.125",
+    # キャプチャ処理の実行場所: "thread"（専用スレッド）/ "inline"（イベントループ上）
+    "CAPTURE_MODE": "thread",
+    # キャプチャ範囲（モニター左上からの {"left", "top", "width", "height"}）。null でモニター全体
+    "CAPTURE_REGION": None,
+    # 出力解像度の上限 [幅, 高さ]（縦横比は保つ）。null で縮小しない
+    "CAPTURE_OUTPUT_SIZE": None,
+    # キャプチャ元: "mss"（実画面）/ "synthetic"（ノベルゲーム風の合成画面）/ "replay"（CAPTURE_REPLAY_PATH の動画を再生）
+    "CAPTURE_BACKEND": "mss",
+    "CAPTURE_REPLAY_PATH": None,
+    # 画面が静止しているときの keep-alive フレームレートと、静止と判定するまでの秒数
+    "SCREEN_IDLE_FPS": 2,
+    "SCREEN_IDLE_DELAY": 0.5,
+    # 場面転換の検出閾値（縮小した輝度の平均差、0〜255。0 で無効）と、転換後にフルレートで送り続ける時間（ミリ秒）
+    "SCENE_CUT_THRESHOLD": 12,
+    "SCENE_CUT_BURST_MS": 1000,
+    # 回線状況（損失率・RTT・ジッター）に合わせて解像度とフレームレートを段階的に下げる。
+    # ADAPTIVE_LADDER は通常の設定の次に使う [幅, 高さ, fps] を品質の高い順に並べる
+    "ADAPTIVE_VIDEO": True,
+    "ADAPTIVE_LADDER": [[1280, 720, 24], [960, 540, 20], [640, 360, 15]],
+    # 配信モード: 映像を 1 回だけエンコードして全接続へ同じパケットを送る（視聴者が増えてもエンコード負荷は 1 本分）。
+    # ビットレートは全接続で共通（bps）で、コーデックは VP8 に固定する
+    "BROADCAST_MODE": False,
+    "BROADCAST_BITRATE": 1500000,
+    # 音声の入力元: "sounddevice"（録音デバイス）/ "synthetic"（合成音声）
+    "AUDIO_BACKEND": "sounddevice",
+    # 音声バッファの目標遅延と上限（ミリ秒）。上限を超えたら古い音声を捨てる
+    "AUDIO_TARGET_LATENCY_MS": 60,
+    "AUDIO_MAX_LATENCY_MS": 200,
+    # 無音区間の間引き（DTX）。閾値は dBFS、無音と判定するまでの時間と keep-alive 間隔はミリ秒
+    "AUDIO_DTX": True,
+    "AUDIO_SILENCE_THRESHOLD_DB": -60,
+    "AUDIO_SILENCE_HANG_MS": 300,
+    "AUDIO_DTX_INTERVAL_MS": 400,
+    # 切断後もキャプチャ・音声と入力セッションを保持する時間（秒）。この間に同じセッショントークンで
+    # 再接続すると、デバイスを開き直さずに最新フレームから再開する。0 で保持しない
+    "SESSION_RESUME_SECONDS": 30,
+    # ホイール 1 ステップに相当するスクロール量（ピクセル）と、scroll を送る最大回数（回/秒）
+    "WHEEL_PIXELS_PER_STEP": 100,
+    "WHEEL_MAX_RATE": 30,
+    # 接続ごとの録画ファイルのパス（{time} は接続時刻に置き換える）。送信中のエンコード済みパケットを
+    # 再エンコードせずに書き出す。拡張子でコンテナが決まる（VP8 は .mkv / .webm）。null で録画しない
+    "RECORD_PATH": None,
+    # メトリクス: Prometheus 形式の HTTP エンドポイント（127.0.0.1 のポート、0 で無効）と JSON ログの間隔（秒、0 で無効）
+    "METRICS_PORT": 0,
+    "METRICS_LOG_INTERVAL": 0,
+    # イベントループ停止時間の計測ログ間隔（秒）。0 で無効
+    "LOOP_LAG_LOG_INTERVAL": 0
+}
+
+# 設定を読み込む関数
+def load_settings():
+    try:
+        with open(CONFIG_FILE, "r") as f:
+            settings = json.load(f)
+            print("読み込んだ設定:", settings)  # デバッグ用出力
+            # 古い設定ファイルに無い項目はデフォルト値で補う
+            return {**default_settings, **settings}
+    except FileNotFoundError:
+        print("設定ファイルが見つかりません。デフォルト設定を使用します。")
+        return dict(default_settings)
+
+# 設定を読み込む
+settings = load_settings()
+
+# 画面キャプチャ設定
+SCREEN_FPS = settings["SCREEN_FPS"]
+SCREEN_MONITOR_INDEX = settings["SCREEN_MONITOR_INDEX"]
+CAPTURE_MODE = settings["CAPTURE_MODE"]
+CAPTURE_REGION = settings["CAPTURE_REGION"]
+CAPTURE_OUTPUT_SIZE = settings["CAPTURE_OUTPUT_SIZE"]
+SCREEN_IDLE_FPS = settings["SCREEN_IDLE_FPS"]
+SCREEN_IDLE_DELAY = settings["SCREEN_IDLE_DELAY"]
+CAPTURE_BACKEND = settings["CAPTURE_BACKEND"]
+CAPTURE_REPLAY_PATH = settings["CAPTURE_REPLAY_PATH"]
+SCENE_CUT_THRESHOLD = settings["SCENE_CUT_THRESHOLD"]
+SCENE_CUT_BURST_MS = settings["SCENE_CUT_BURST_MS"]
+ADAPTIVE_VIDEO = settings["ADAPTIVE_VIDEO"]
+ADAPTIVE_LADDER = settings["ADAPTIVE_LADDER"]
+BROADCAST_MODE = settings["BROADCAST_MODE"]
+BROADCAST_BITRATE = settings["BROADCAST_BITRATE"]
+
+# 音声キャプチャ設定
+AUDIO_SAMPLE_RATE = settings["AUDIO_SAMPLE_RATE"]
+AUDIO_CHANNELS = settings["AUDIO_CHANNELS"]
+AUDIO_BACKEND = settings["AUDIO_BACKEND"]
+AUDIO_TARGET_LATENCY_MS = settings["AUDIO_TARGET_LATENCY_MS"]
+AUDIO_MAX_LATENCY_MS = settings["AUDIO_MAX_LATENCY_MS"]
+AUDIO_DTX = settings["AUDIO_DTX"]
+AUDIO_SILENCE_THRESHOLD_DB = settings["AUDIO_SILENCE_THRESHOLD_DB"]
+AUDIO_SILENCE_HANG_MS = settings["AUDIO_SILENCE_HANG_MS"]
+AUDIO_DTX_INTERVAL_MS = settings["AUDIO_DTX_INTERVAL_MS"]
+
+# セッション再開の猶予
+SESSION_RESUME_SECONDS = settings["SESSION_RESUME_SECONDS"]
+
+# ホイール設定
+WHEEL_PIXELS_PER_STEP = settings["WHEEL_PIXELS_PER_STEP"]
+WHEEL_MAX_RATE = settings["WHEEL_MAX_RATE"]
+
+# 録画設定
+RECORD_PATH = settings["RECORD_PATH"]
+
+# サーバーのIPアドレス設定
+SERVER_IP = settings["SERVER_IP"]
+
+# イベントループ停止時間の計測設定
+LOOP_LAG_LOG_INTERVAL = settings["LOOP_LAG_LOG_INTERVAL"]
+
+# メトリクス設定
+METRICS_PORT = settings["METRICS_PORT"]
+METRICS_LOG_INTERVAL = settings["METRICS_LOG_INTERVAL"]
+METRICS_ENABLED = METRICS_PORT > 0 or METRICS_LOG_INTERVAL > 0
+# 送信統計（ビットレート・RTT・損失率）を取得する間隔（秒）
+SENDER_STATS_INTERVAL = 2.0
+
+# 0 以下にできない項目（フレームレートなど割り算に使うもの）
+_POSITIVE_SETTINGS = {"SCREEN_FPS", "SCREEN_IDLE_FPS", "AUDIO_SAMPLE_RATE", "AUDIO_CHANNELS", "BROADCAST_BITRATE", "AUDIO_MAX_LATENCY_MS", "WHEEL_PIXELS_PER_STEP", "WHEEL_MAX_RATE"}
+# 負にできない項目（時間・閾値・番号）
+_NON_NEGATIVE_SETTINGS = {
+    "SCREEN_MONITOR_INDEX", "SCREEN_IDLE_DELAY", "SCENE_CUT_THRESHOLD", "SCENE_CUT_BURST_MS",
+    "AUDIO_TARGET_LATENCY_MS", "AUDIO_SILENCE_HANG_MS", "AUDIO_DTX_INTERVAL_MS", "SESSION_RESUME_SECONDS",
+    "METRICS_PORT", "METRICS_LOG_INTERVAL", "LOOP_LAG_LOG_INTERVAL"
+}
+# 整数だけを受け付ける項目
+_INT_SETTINGS = {"SCREEN_MONITOR_INDEX", "AUDIO_SAMPLE_RATE", "AUDIO_CHANNELS", "METRICS_PORT"}
+# 上限のある項目
+_MAX_SETTINGS = {"SCENE_CUT_THRESHOLD": 255, "METRICS_PORT": 65535, "AUDIO_SILENCE_THRESHOLD_DB": 0}
+# 決まった値だけを受け付ける項目
+_CHOICE_SETTINGS = {
+    "CAPTURE_MODE": ("thread", "inline"),
+    "CAPTURE_BACKEND": ("mss", "synthetic", "replay"),
+    "AUDIO_BACKEND": ("sounddevice", "synthetic"),
+    "AUDIO_CHANNELS": (1, 2)
+}
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _valid_region(value):
+    # {"left", "top", "width", "height"} の一部（省略した項目はモニター全体の値）
+    if value is None:
+        return True
+    if not isinstance(value, dict) or not value or not set(value) <= {"left", "top", "width", "height"}:
+        return False
+    if not all(_is_int(v) for v in value.values()):
+        return False
+    return value.get("left", 0) >= 0 and value.get("top", 0) >= 0 and value.get("width", 1) > 0 and value.get("height", 1) > 0
+
+def _valid_size(value):
+    # [幅, 高さ]
+    if value is None:
+        return True
+    return isinstance(value, list) and len(value) == 2 and all(_is_int(v) and v > 0 for v in value)
+
+def _valid_ladder(value):
+    # [[幅, 高さ, fps], ...]
+    return isinstance(value, list) and all(
+        isinstance(step, list) and len(step) == 3 and _valid_size(step[:2]) and _is_number(step[2]) and step[2] > 0
+        for step in value
+    )
+
+def _valid_path(value):
+    return value is None or (isinstance(value, str) and value != "")
+
+# 形を確かめる項目（デフォルトが null やリストのもの）
+_SHAPE_SETTINGS = {
+    "CAPTURE_REGION": _valid_region,
+    "CAPTURE_OUTPUT_SIZE": _valid_size,
+    "ADAPTIVE_LADDER": _valid_ladder,
+    "CAPTURE_REPLAY_PATH": _valid_path,
+    "RECORD_PATH": _valid_path
+}
+
+# 値の型と範囲を確かめる（型はデフォルト値に合わせ、整数と小数は区別しない）
+def _valid_value(key, value):
+    if key in _SHAPE_SETTINGS:
+        return _SHAPE_SETTINGS[key](value)
+    default = default_settings[key]
+    if isinstance(default, bool):
+        return isinstance(value, bool)
+    if isinstance(default, (int, float)):
+        if not (_is_int(value) if key in _INT_SETTINGS else _is_number(value)):
+            return False
+        if key in _POSITIVE_SETTINGS and value <= 0:
+            return False
+        if key in _NON_NEGATIVE_SETTINGS and value < 0:
+            return False
+        if key in _MAX_SETTINGS and value > _MAX_SETTINGS[key]:
+            return False
+    elif not isinstance(value, type(default)):
+        return False
+    return key not in _CHOICE_SETTINGS or value in _CHOICE_SETTINGS[key]
+
+# 動作中に設定を変更する関数（変更された項目を dict で返す）
+def update_settings(values):
+    changed = {}
+    for key, value in values.items():
+        if key not in default_settings:
+            print(f"不明な設定項目を無視します: {key}")
+            continue
+        if not _valid_value(key, value):
+            print(f"設定値が正しくないため無視します: {key}={value!r}")
+            continue
+        if settings.get(key) != value:
+            settings[key] = value
+            # 下の定数も差し替える。動作中に変わる設定は使う時点で settings.X として読む（from settings import で読んだ値は変わらない）
+            globals()[key] = value
+            changed[key] = value
+    if changed:
+        print("変更された設定:", changed)
+    return changed
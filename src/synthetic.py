@@ -0,0 +1,222 @@
+import threading
+import time
+import cv2
+import numpy as np
+
+
+# 合成画面に流す台詞（cv2.putText で描けるよう ASCII のみ）
+SAMPLE_LINES = [
+	"The rain had not stopped since morning, and the station was almost empty.",
+	"\"You came after all,\" she said, without looking up from her book.",
+	"I had meant to say something clever. Nothing came to mind.",
+	"Somewhere behind us a train announced its departure, twice, then went quiet.",
+]
+
+
+class _Shot:
+	"""mss の ScreenShot と同じく raw（bytearray）と __array_interface__ を持つ画像"""
+
+	def __init__(self, image):
+		h, w = image.shape[:2]
+		self.width = w
+		self.height = h
+		self.raw = bytearray(image.nbytes)
+		np.frombuffer(self.raw, np.uint8).reshape(h, w, 4)[...] = image
+
+	@property
+	def __array_interface__(self):
+		return {
+			"version": 3,
+			"shape": (self.height, self.width, 4),
+			"typestr": "|u1",
+			"data": self.raw,
+		}
+
+
+class _ScreenSource:
+	"""mss.mss() の代わりに使うキャプチャ元の共通部分（with 文と monitors）"""
+
+	def __init__(self, width, height, monitor_count=1):
+		rect = {"left": 0, "top": 0, "width": width, "height": height}
+		# monitors[0] は全体、1 以降が各モニター（mss と同じ並び）。どの番号でも同じ画面を返す
+		self.monitors = [dict(rect) for _ in range(monitor_count + 1)]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		pass
+
+	def _crop(self, image, monitor):
+		x = monitor.get("left", 0)
+		y = monitor.get("top", 0)
+		return image[y:y + monitor["height"], x:x + monitor["width"]]
+
+
+class SyntheticScreen(_ScreenSource):
+	"""ノベルゲーム風の画面を生成するキャプチャ元。
+
+	静止した背景の上で、下部のテキストボックスに chars_per_second 文字/秒で台詞が
+	表示され、表示し終えたら次のシーンまで静止する。scene_interval 秒ごとに
+	別の背景へ transition 秒かけてクロスフェードする（画面全体が変化する）。
+	clock は経過秒数を返す関数で、省略時は実時間。ベンチマークではフレーム番号から
+	求めた時刻を渡し、毎回同じ内容を再現する。
+	"""
+
+	def __init__(self, width=1920, height=1080, monitor_count=1, chars_per_second=30,
+			scene_interval=8.0, transition=0.5, clock=None, seed=0):
+		super().__init__(width, height, monitor_count)
+		self.width = width
+		self.height = height
+		self.chars_per_second = chars_per_second
+		self.scene_interval = scene_interval
+		self.transition = transition
+		if clock is None:
+			started = time.monotonic()
+			clock = lambda: time.monotonic() - started
+		self.clock = clock
+		rng = np.random.default_rng(seed)
+		self._backgrounds = [self._render_background(rng) for _ in range(3)]
+		self._frame = np.empty((height, width, 4), np.uint8)
+		box_h = height // 4
+		self._box = (width // 20, height - box_h - height // 30, width - width // 10, box_h)
+		self._font_scale = height / 1080 * 1.1
+
+	def _render_background(self, rng):
+		h, w = self.height, self.width
+		# 縦方向のグラデーションに大きな図形を数個重ねる
+		top = rng.integers(40, 200, 3)
+		bottom = rng.integers(40, 200, 3)
+		t = np.linspace(0.0, 1.0, h, dtype=np.float32)[:, None]
+		bg = np.empty((h, w, 4), np.uint8)
+		bg[..., :3] = (top * (1 - t) + bottom * t)[:, None, :].astype(np.uint8)
+		bg[..., 3] = 255
+		for _ in range(6):
+			center = (int(rng.integers(0, w)), int(rng.integers(0, h)))
+			radius = int(rng.integers(h // 10, h // 3))
+			color = tuple(int(c) for c in rng.integers(0, 256, 3)) + (255,)
+			cv2.circle(bg, center, radius, color, -1, lineType=cv2.LINE_AA)
+		return bg
+
+	def _scene(self, now):
+		index = int(now // self.scene_interval)
+		return index, now - index * self.scene_interval
+
+	def _render(self, now):
+		scene, elapsed = self._scene(now)
+		frame = self._frame
+		bg = self._backgrounds[scene % len(self._backgrounds)]
+		if scene > 0 and elapsed < self.transition:
+			prev = self._backgrounds[(scene - 1) % len(self._backgrounds)]
+			alpha = elapsed / self.transition
+			cv2.addWeighted(bg, alpha, prev, 1.0 - alpha, 0.0, dst=frame)
+			return frame
+		frame[...] = bg
+		# テキストボックス（半透明の黒）と台詞
+		x, y, w, h = self._box
+		box = frame[y:y + h, x:x + w]
+		np.right_shift(box, 1, out=box)
+		box[..., 3] = 255
+		line = SAMPLE_LINES[scene % len(SAMPLE_LINES)]
+		shown = int(max(elapsed - self.transition, 0.0) * self.chars_per_second)
+		text = line[:shown]
+		if text:
+			baseline = y + int(h * 0.35)
+			cv2.putText(frame, text, (x + w // 30, baseline), cv2.FONT_HERSHEY_SIMPLEX,
+				self._font_scale, (255, 255, 255, 255), max(int(self._font_scale * 2), 1), cv2.LINE_AA)
+		return frame
+
+	def grab(self, monitor):
+		return _Shot(self._crop(self._render(self.clock()), monitor))
+
+
+class ReplayScreen(_ScreenSource):
+	"""動画ファイル（または cv2.VideoCapture が読める連番画像）を 1 グラブ 1 フレームで再生する"""
+
+	def __init__(self, path, monitor_count=1, loop=True):
+		self.path = path
+		self.loop = loop
+		self._video = cv2.VideoCapture(path)
+		if not self._video.isOpened():
+			raise ValueError(f"cannot open replay source: {path}")
+		width = int(self._video.get(cv2.CAP_PROP_FRAME_WIDTH))
+		height = int(self._video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+		super().__init__(width, height, monitor_count)
+		self._frame = np.zeros((height, width, 4), np.uint8)
+
+	def close(self):
+		self._video.release()
+
+	def _next(self):
+		ok, image = self._video.read()
+		if not ok and self.loop:
+			self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+			ok, image = self._video.read()
+		if ok:
+			cv2.cvtColor(image, cv2.COLOR_BGR2BGRA, dst=self._frame)
+		# 終端に達したら最後のフレームを返し続ける
+		return self._frame
+
+	def grab(self, monitor):
+		return _Shot(self._crop(self._next(), monitor))
+
+
+class SyntheticAudio:
+	"""台詞の読み上げに似た音声（有音区間と無音区間の繰り返し）を生成する音源"""
+
+	def __init__(self, samplerate=48000, channels=1, voice_seconds=2.0, silence_seconds=1.5, level_db=-12.0):
+		self.samplerate = samplerate
+		self.channels = channels
+		self.period = int(samplerate * (voice_seconds + silence_seconds))
+		self.voice = int(samplerate * voice_seconds)
+		self.amplitude = 32767 * 10 ** (level_db / 20)
+		self._pos = 0
+
+	def read(self, frames):
+		"""次の frames サンプル分を (frames, channels) の int16 で返す"""
+		n = np.arange(self._pos, self._pos + frames)
+		self._pos += frames
+		t = n / self.samplerate
+		voiced = (n % self.period) < self.voice
+		# 基本周波数 180Hz の倍音に 4Hz の音節のような抑揚をつける
+		wave = np.sin(2 * np.pi * 180 * t) + 0.5 * np.sin(2 * np.pi * 360 * t) + 0.25 * np.sin(2 * np.pi * 540 * t)
+		envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t) ** 2
+		samples = (wave * envelope * voiced * (self.amplitude / 1.75)).astype(np.int16)
+		return np.repeat(samples[:, None], self.channels, axis=1)
+
+
+class SyntheticAudioStream:
+	"""sd.InputStream の代わりに SyntheticAudio を実時間でコールバックへ渡すストリーム"""
+
+	def __init__(self, samplerate, channels, blocksize, callback, device=None):
+		self.source = SyntheticAudio(samplerate, channels)
+		self.blocksize = blocksize
+		self.callback = callback
+		self.block_time = blocksize / samplerate
+		self._stop_event = threading.Event()
+		self._thread = None
+
+	def start(self):
+		self._stop_event.clear()
+		self._thread = threading.Thread(target=self._run, name="SyntheticAudio", daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self._stop_event.set()
+
+	def close(self):
+		self._stop_event.set()
+
+	def _run(self):
+		next_time = time.monotonic()
+		while not self._stop_event.is_set():
+			self.callback(self.source.read(self.blocksize), self.blocksize, None, None)
+			next_time += self.block_time
+			wait = next_time - time.monotonic()
+			if wait > 0:
+				self._stop_event.wait(wait)
+			else:
+				next_time = time.monotonic()
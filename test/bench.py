@@ -0,0 +1,242 @@
+"""
+Headless benchmark for the capture and audio pipelines.
+
+- video: synthetic visual-novel screen (static background, typing text box,
+  scene transitions every few seconds) -> ScreenCapture grab / tile diff /
+  I420 conversion / cursor composite -> VideoFrame (-> VP8 with --encode)
+- audio: synthetic speech-like source -> ring buffer -> reader -> silence gate
+  -> AudioFrame (-> Opus with --encode)
+
+Reports frames/s, per-frame latency (p50/p95/max), CPU time per frame and
+allocations per frame (tracemalloc peak, measured in a separate pass so the
+timings are not affected). The video grab includes the synthetic source
+copying the frame into a fresh buffer, as mss does for every grab.
+No display or audio device is needed.
+
+Usage:
+    python bench.py
+    python bench.py --sizes 1280x720 1920x1080 --frames 600 --encode
+    python bench.py --save baseline.json
+    python bench.py --compare baseline.json --tolerance 0.2   # exit 1 on regression
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from audio import AudioRingBuffer, SilenceGate  # noqa: E402
+from capture import ScreenCapture  # noqa: E402
+from cursor import CursorState  # noqa: E402
+from synthetic import SyntheticAudio, SyntheticScreen  # noqa: E402
+
+
+def summarize(name, latencies, wall, cpu, alloc, extra=None):
+    lat = np.array(latencies) * 1000
+    result = {
+        'name': name,
+        'frames': len(latencies),
+        'fps': len(latencies) / wall,
+        'p50_ms': float(np.percentile(lat, 50)),
+        'p95_ms': float(np.percentile(lat, 95)),
+        'max_ms': float(lat.max()),
+        'cpu_ms': cpu / len(latencies) * 1000,
+        'alloc_mb': alloc / 2**20,
+    }
+    if extra:
+        result.update(extra)
+    return result
+
+
+def video_frames(width, height, fps, frames, encode):
+    """フレームごとの処理を行うジェネレーター（1 フレーム処理するごとに変化の有無を返す）"""
+    from av import VideoFrame
+    encoder = None
+    if encode:
+        from aiortc.codecs.vpx import Vp8Encoder
+        encoder = Vp8Encoder()
+    index = [0]
+    screen = SyntheticScreen(width, height, clock=lambda: index[0] / fps)
+    cursor = CursorState()
+    capture = ScreenCapture(1, fps, cursor=cursor, backend=lambda: screen)
+    monitor = capture._grab_rect(screen)
+    # ここまでの準備は計測に含めない
+    yield None
+    for i in range(frames):
+        index[0] = i
+        # 2 秒ごとに 0.5 秒間カーソルを動かす
+        if (i % (2 * fps)) < fps // 2:
+            cursor.update((width // 2 + (i * 7) % (width // 3), height // 2 + (i * 3) % (height // 4)))
+        frame = capture._grab(screen, monitor)
+        changed = frame is not None
+        if changed:
+            # 購読側と同じく最新フレームとして保持する（プールの再利用判定もこれに従う）
+            capture.frame = frame
+            video_frame = VideoFrame.from_numpy_buffer(frame.image, format='yuv420p')
+            video_frame.pts = i
+            if encoder is not None:
+                encoder.encode(video_frame)
+            del video_frame
+        yield changed
+
+
+def audio_blocks(samplerate, channels, blocks, encode):
+    from av import AudioFrame
+    import fractions
+    encoder = None
+    if encode:
+        from aiortc.codecs.opus import OpusEncoder
+        encoder = OpusEncoder()
+    blocksize = int(samplerate * 0.02)
+    source = SyntheticAudio(samplerate, channels)
+    ring = AudioRingBuffer(samplerate // 5, channels)
+    reader = ring.reader(int(samplerate * 0.06))
+    gate = SilenceGate()
+    block = np.zeros((blocksize, channels), np.int16)
+    layout = 'mono' if channels == 1 else 'stereo'
+    for i in range(blocks):
+        data = source.read(blocksize)
+        # 準備と生成は計測に含めない
+        yield None
+        ring.write(data)
+        reader.read(block)
+        active = gate.update(block)
+        if active:
+            frame = AudioFrame(format='s16', layout=layout, samples=blocksize)
+            frame.planes[0].update(block)
+            frame.sample_rate = samplerate
+            frame.pts = i * blocksize
+            frame.time_base = fractions.Fraction(1, samplerate)
+            if encoder is not None:
+                encoder.encode(frame)
+        yield active
+
+
+def run_timed(steps):
+    latencies = []
+    flags = []
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    started = time.perf_counter()
+    for flag in steps:
+        if flag is None:
+            # 計測対象外の準備が終わった
+            started = time.perf_counter()
+            continue
+        now = time.perf_counter()
+        latencies.append(now - started)
+        flags.append(flag)
+        started = time.perf_counter()
+    return latencies, flags, time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+
+def run_alloc(steps):
+    """1 ステップあたりの最大一時確保量（バイト）の平均"""
+    tracemalloc.start()
+    peaks = []
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    for flag in steps:
+        if flag is None:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            continue
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # 最初の数フレームはバッファの確保を含むため除く
+    skip = min(len(peaks) // 10, 10)
+    return float(np.mean(peaks[skip:])) if peaks[skip:] else 0.0
+
+
+def bench_video(width, height, fps, frames, encode):
+    latencies, flags, wall, cpu = run_timed(video_frames(width, height, fps, frames, encode))
+    alloc = run_alloc(video_frames(width, height, fps, max(frames // 4, 30), encode))
+    return summarize(
+        f'video {width}x{height}' + (' +vp8' if encode else ''),
+        latencies, wall, cpu, alloc,
+        {'changed': sum(flags) / len(flags)}
+    )
+
+
+def bench_audio(samplerate, channels, blocks, encode):
+    latencies, flags, wall, cpu = run_timed(audio_blocks(samplerate, channels, blocks, encode))
+    alloc = run_alloc(audio_blocks(samplerate, channels, max(blocks // 4, 50), encode))
+    return summarize(
+        f'audio {samplerate}Hz/{channels}ch' + (' +opus' if encode else ''),
+        latencies, wall, cpu, alloc,
+        {'changed': sum(flags) / len(flags)}
+    )
+
+
+def print_results(results):
+    header = f"{'benchmark':<28}{'frames/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}{'cpu ms':>9}{'alloc MB':>10}{'active':>8}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['name']:<28}{r['fps']:>10.1f}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['max_ms']:>9.2f}"
+              f"{r['cpu_ms']:>9.2f}{r['alloc_mb']:>10.3f}{r['changed']:>8.0%}")
+
+
+def compare(results, baseline, tolerance):
+    """ベースラインより tolerance の割合以上悪化した項目を返す"""
+    base = {r['name']: r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get(r['name'])
+        if b is None:
+            continue
+        if r['fps'] < b['fps'] * (1 - tolerance):
+            regressions.append(f"{r['name']}: frames/s {b['fps']:.1f} -> {r['fps']:.1f}")
+        for key in ('p95_ms', 'cpu_ms'):
+            if r[key] > b[key] * (1 + tolerance):
+                regressions.append(f"{r['name']}: {key} {b[key]:.2f} -> {r[key]:.2f}")
+        # 確保量はわずかな揺れで誤検出しないよう 0.1MB 以上の増加のみ数える
+        if r['alloc_mb'] > b['alloc_mb'] * (1 + tolerance) + 0.1:
+            regressions.append(f"{r['name']}: alloc_mb {b['alloc_mb']:.3f} -> {r['alloc_mb']:.3f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless capture/audio pipeline benchmark')
+    parser.add_argument('--sizes', nargs='+', default=['1280x720', '1920x1080', '2560x1440'])
+    parser.add_argument('--fps', type=int, default=30, help='simulated capture rate (drives the synthetic timeline)')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--audio-blocks', type=int, default=1000)
+    parser.add_argument('--encode', action='store_true', help='include VP8/Opus encoding')
+    parser.add_argument('--save', help='write results as JSON')
+    parser.add_argument('--compare', help='baseline JSON written by --save')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        width, height = (int(v) for v in size.lower().split('x'))
+        results.append(bench_video(width, height, args.fps, args.frames, args.encode))
+    results.append(bench_audio(48000, 1, args.audio_blocks, args.encode))
+    results.append(bench_audio(48000, 2, args.audio_blocks, args.encode))
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'saved to {args.save}')
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('REGRESSIONS:')
+            for line in regressions:
+                print('  ' + line)
+            sys.exit(1)
+        print('no regressions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Headless session recording for regression captures.
+
+Runs the server's offer handler and a receive-only WebRTC client in one
+process over loopback, so the real ScreenTrack / SystemAudioTrack and
+RTCRtpSender path is exercised. It then records what the senders send
+with RECORD_PATH, without re-encoding. The synthetic backends are the
+default, so no display, audio device or browser is needed and the
+capture is repeatable.
+
+After the recording is closed, prints the streams, frame counts and
+duration of the file.
+
+Usage:
+    python record.py --seconds 10 --output capture.mkv [--force]
+    python record.py --backend replay --replay route.mp4 --output route.mkv
+    python record.py --broadcast --output broadcast.webm
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import settings  # noqa: E402
+
+
+async def receive(url, seconds):
+    import websockets
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from aiortc.contrib.media import MediaBlackhole
+
+    pc = RTCPeerConnection()
+    pc.addTransceiver('video', direction='recvonly')
+    pc.addTransceiver('audio', direction='recvonly')
+    # 受信したフレームは読み捨てる（受信側のキューを溜めない）
+    sink = MediaBlackhole()
+    pc.on('track', sink.addTrack)
+    async with websockets.connect(url) as ws:
+        await pc.setLocalDescription(await pc.createOffer())
+        await ws.send(json.dumps({'type': 'offer', 'sdp': pc.localDescription.sdp}))
+        while True:
+            msg = json.loads(await ws.recv())
+            if msg.get('type') == 'answer':
+                await pc.setRemoteDescription(RTCSessionDescription(sdp=msg['sdp'], type='answer'))
+                break
+        await sink.start()
+        await asyncio.sleep(seconds)
+    await sink.stop()
+    await pc.close()
+
+
+async def record(seconds):
+    import websockets
+    import peer
+
+    async with websockets.serve(peer.offer, '127.0.0.1', 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        await receive(f'ws://127.0.0.1:{port}/', seconds)
+        # サーバー側の切断処理（録画の終了）が終わるまで待つ
+        while peer.pcs:
+            await asyncio.sleep(0.1)
+
+
+def describe(path):
+    import av
+    with av.open(path) as container:
+        print(f'{path}: {container.duration / 1e6 if container.duration else 0:.2f} s')
+        for stream in container.streams:
+            packets = sum(1 for packet in container.demux(stream) if packet.size)
+            container.seek(0)
+            size = f' {stream.codec_context.width}x{stream.codec_context.height}' if stream.type == 'video' else ''
+            print(f'  {stream.type}: {stream.codec_context.name}{size}, {packets} packets')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless session recording (no re-encode)')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--output', default='recording.mkv', help='.mkv / .webm (VP8), .mp4 only with H264')
+    parser.add_argument('--backend', default='synthetic', choices=['synthetic', 'replay', 'mss'])
+    parser.add_argument('--replay', help='video file for --backend replay')
+    parser.add_argument('--broadcast', action='store_true', help='record the shared encoder of BROADCAST_MODE')
+    parser.add_argument('--force', action='store_true', help='overwrite --output if it exists')
+    args = parser.parse_args()
+
+    if os.path.exists(args.output):
+        if not args.force:
+            parser.error(f'{args.output} already exists (use --force to overwrite)')
+        os.remove(args.output)
+    # 接続する前に設定を差し替える（peer は接続のたびに settings の値を読む）
+    settings.update_settings({
+        'CAPTURE_BACKEND': args.backend,
+        'CAPTURE_REPLAY_PATH': args.replay,
+        'AUDIO_BACKEND': 'synthetic' if args.backend != 'mss' else settings.AUDIO_BACKEND,
+        'BROADCAST_MODE': args.broadcast,
+        'SESSION_RESUME_SECONDS': 0,
+        'RECORD_PATH': args.output,
+    })
+    asyncio.run(record(args.seconds))
+    # 録画の writer スレッドがファイルを閉じるまで待つ
+    for thread in threading.enumerate():
+        if thread.name == 'SessionRecorder':
+            thread.join()
+    if os.path.exists(args.output):
+        describe(args.output)
+    else:
+        print(f'{args.output} was not written')
+
+
+if __name__ == '__main__':
+    main()